@@ -0,0 +1,77 @@
+import os
+import re
+import base64
+import hashlib
+from collections import OrderedDict
+
+AVATAR_DIR = "hub_avatars"
+MEMORY_SLOTS = 64
+MAX_FILES = 500
+HASH_SIZE = 16
+HASH_RE = re.compile(r"[0-9a-f]{%d}" % HASH_SIZE)
+
+def avatar_hash(image):
+    return hashlib.sha1(image).hexdigest()[:HASH_SIZE] if image else ""
+
+def valid_hash(avatar):
+    """Hashes arrive off the wire, so nothing else may reach a file path."""
+    return bool(avatar) and HASH_RE.fullmatch(avatar) is not None
+
+class AvatarStore:
+    """Avatar images stored by hash under hub_avatars/, with a small LRU of decoded entries in memory.
+    Only the hash travels in rosters and profiles; the image is fetched once and then served from disk."""
+    def __init__(self, root=AVATAR_DIR, slots=MEMORY_SLOTS):
+        self.root = root
+        self.slots = slots
+        self.memory = OrderedDict()
+        os.makedirs(root, exist_ok=True)
+        self.prune()
+
+    def path(self, avatar):
+        return os.path.join(self.root, avatar + ".img")
+
+    def has(self, avatar):
+        return valid_hash(avatar) and (avatar in self.memory or os.path.exists(self.path(avatar)))
+
+    def put(self, image):
+        avatar = avatar_hash(image)
+        if not avatar: return ""
+        if not os.path.exists(self.path(avatar)):
+            try:
+                with open(self.path(avatar) + ".tmp", 'wb') as f: f.write(image)
+                os.replace(self.path(avatar) + ".tmp", self.path(avatar))
+            except OSError: pass
+            self.prune()
+        self.remember(avatar, image)
+        return avatar
+
+    def get(self, avatar):
+        if not valid_hash(avatar): return None
+        if avatar in self.memory:
+            self.memory.move_to_end(avatar)
+            return self.memory[avatar]
+        try:
+            with open(self.path(avatar), 'rb') as f: image = f.read()
+            os.utime(self.path(avatar)) # Keeps recently seen avatars clear of prune()
+        except OSError: return None
+        if avatar_hash(image) != avatar: return None
+        self.remember(avatar, image)
+        return image
+
+    def b64(self, avatar):
+        image = self.get(avatar)
+        return base64.b64encode(image).decode() if image else ""
+
+    def remember(self, avatar, image):
+        self.memory[avatar] = image
+        self.memory.move_to_end(avatar)
+        while len(self.memory) > self.slots: self.memory.popitem(last=False)
+
+    def prune(self):
+        try: names = [os.path.join(self.root, n) for n in os.listdir(self.root)]
+        except OSError: return
+        if len(names) <= MAX_FILES: return
+        names.sort(key=lambda p: os.path.getmtime(p))
+        for path in names[:len(names) - MAX_FILES]:
+            try: os.remove(path)
+            except OSError: pass
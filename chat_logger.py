@@ -1,28 +1,152 @@
 import json
 import os
+import re
+import time
+import sqlite3
+import threading
+
+LOG_DIR = "logs"
+COMMIT_INTERVAL = 0.25 # Group commit: messages queued within this window share one transaction and one fsync
+COMMIT_BATCH = 256
+PAGE_SIZE = 50
+SEARCH_PAGE = 20
 
 class ChatLogger:
-    """Saves and Loads chat history based on the unique Room Code."""
+    """Saves and Loads chat history based on the unique Room Code.
+    History lives in logs/chat_<code>.db, SQLite in WAL mode. add_message only queues the row; a writer
+    thread commits whatever piled up in one transaction, so the listener never waits on the disk.
+    Nothing is ever truncated and reads are paged by message id. An FTS5 index over the text is kept
+    in step by an insert trigger, so search never rescans the log."""
     def __init__(self, room_code):
         self.room_code = room_code
         # Auto-create the logs folder
-        os.makedirs("logs", exist_ok=True)
-        self.filepath = os.path.join("logs", f"chat_log_{room_code}.json")
-        self.history = []
-        self.load()
+        os.makedirs(LOG_DIR, exist_ok=True)
+        self.filepath = os.path.join(LOG_DIR, f"chat_{room_code}.db")
+        self.lock = threading.Lock() # Guards the queue only, so add_message never waits on the disk
+        self.cond = threading.Condition(self.lock)
+        self.db_lock = threading.Lock()
+        self.pending = []
+        self.closed = False
+
+        self.db = sqlite3.connect(self.filepath, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, ts REAL NOT NULL, uid TEXT, nick TEXT, msg TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts)")
+        self.db.commit()
+        self.fts = self.create_index()
+        self.last_id = self.db.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+        if not self.last_id: self.import_json()
+
+        self.writer = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer.start()
+
+    def create_index(self):
+        try:
+            exists = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(msg, content='messages', content_rowid='id')")
+            self.db.execute("CREATE TRIGGER IF NOT EXISTS messages_fts_add AFTER INSERT ON messages BEGIN INSERT INTO messages_fts(rowid, msg) VALUES (new.id, new.msg); END")
+            if not exists: self.db.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')") # Logs from before the index
+            self.db.commit()
+            return True
+        except sqlite3.Error: return False # SQLite built without FTS5; search falls back to LIKE
 
-    def load(self):
-        if os.path.exists(self.filepath):
+    def import_json(self):
+        # Logs from before the database kept the last 100 messages as one JSON file
+        legacy = os.path.join(LOG_DIR, f"chat_log_{self.room_code}.json")
+        try:
+            with open(legacy, 'r') as f: history = json.load(f)
+        except (OSError, ValueError): return
+        now = time.time()
+        for m in history:
+            if isinstance(m, dict): self.add_message(m.get("uid", ""), m.get("nick", ""), m.get("msg", ""), now)
+        self.flush()
+
+    def add_message(self, uid, nick, msg, ts=None):
+        """Queues a message and returns its id; it reaches the disk with the next group commit."""
+        with self.lock:
+            self.last_id += 1
+            self.pending.append((self.last_id, time.time() if ts is None else ts, uid, nick, msg))
+            if len(self.pending) >= COMMIT_BATCH: self.cond.notify()
+            return self.last_id
+
+    def writer_loop(self):
+        while True:
+            with self.lock:
+                if self.closed: return
+                self.cond.wait(COMMIT_INTERVAL)
+            self.commit()
+
+    def commit(self):
+        # The queue is swapped out under the db lock, so concurrent commits still land in id order
+        with self.db_lock:
+            with self.lock: batch, self.pending = self.pending, []
+            if not batch: return
             try:
-                with open(self.filepath, 'r') as f:
-                    self.history = json.load(f)
-            except:
-                pass
-
-    def save(self):
-        with open(self.filepath, 'w') as f:
-            json.dump(self.history[-100:], f, indent=4) # Keep the last 100 messages
-
-    def add_message(self, uid, nick, msg):
-        self.history.append({"uid": uid, "nick": nick, "msg": msg})
-        self.save()
\ No newline at end of file
+                with self.db: self.db.executemany("INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?)", batch)
+            except sqlite3.Error:
+                with self.lock: self.pending[:0] = batch # Retried with the next commit
+
+    def flush(self):
+        self.commit()
+
+    def rows(self, query, args):
+        self.commit() # Reads see everything added so far
+        with self.db_lock:
+            try: cur = self.db.execute(query, args).fetchall()
+            except sqlite3.Error: return []
+        return [{"id": r[0], "ts": r[1], "uid": r[2], "nick": r[3], "msg": r[4]} for r in cur]
+
+    def latest(self, limit=PAGE_SIZE):
+        return self.before(None, limit)
+
+    def before(self, message_id, limit=PAGE_SIZE):
+        """Up to limit messages older than message_id (or the newest ones), oldest first."""
+        if message_id is None: message_id = self.last_id + 1
+        rows = self.rows("SELECT id, ts, uid, nick, msg FROM messages WHERE id < ? ORDER BY id DESC LIMIT ?", (message_id, limit))
+        return rows[::-1]
+
+    def after(self, message_id, limit=PAGE_SIZE):
+        """Up to limit messages newer than message_id, oldest first."""
+        return self.rows("SELECT id, ts, uid, nick, msg FROM messages WHERE id > ? ORDER BY id LIMIT ?", (message_id, limit))
+
+    def since(self, ts, limit=PAGE_SIZE):
+        return self.rows("SELECT id, ts, uid, nick, msg FROM messages WHERE ts >= ? ORDER BY ts, id LIMIT ?", (ts, limit))
+
+    def search(self, query, uid=None, since=None, until=None, before=None, limit=SEARCH_PAGE):
+        """Newest-first messages containing every word of query (each as a prefix), optionally from one
+        sender and between two unix times. Page on by passing the last result's id as before."""
+        words = re.findall(r"\w+", query or "")
+        if not words: return []
+        # Filter and order on the index's own rowid so FTS5 walks its matches newest first without a sort
+        key = "f.rowid" if self.fts else "m.id"
+        if self.fts:
+            sql = "SELECT m.id, m.ts, m.uid, m.nick, m.msg FROM messages_fts f JOIN messages m ON m.id = f.rowid WHERE messages_fts MATCH ?"
+            args = [" ".join('"%s"*' % w for w in words)]
+        else:
+            sql = "SELECT m.id, m.ts, m.uid, m.nick, m.msg FROM messages m WHERE " + " AND ".join(["m.msg LIKE ? ESCAPE '\\'"] * len(words))
+            args = ["%" + w.replace("_", "\\_") + "%" for w in words]
+        # Ids grow with time, so the time range becomes an id range the index can seek on
+        if since is not None:
+            sql += f" AND {key} >= COALESCE((SELECT MIN(id) FROM messages WHERE ts >= ?), 1 << 62)"
+            args.append(float(since))
+        if until is not None:
+            sql += f" AND {key} <= COALESCE((SELECT MAX(id) FROM messages WHERE ts < ?), 0)"
+            args.append(float(until))
+        if before:
+            sql += f" AND {key} < ?"
+            args.append(int(before))
+        if uid:
+            sql += " AND m.uid = ?"
+            args.append(uid)
+        return self.rows(sql + f" ORDER BY {key} DESC LIMIT ?", args + [int(limit)])
+
+    def close(self):
+        with self.lock:
+            if self.closed: return
+            self.closed = True
+            self.cond.notify()
+        self.commit()
+        with self.db_lock:
+            try: self.db.close()
+            except sqlite3.Error: pass
@@ -2,6 +2,8 @@ import json
 import os
 import string
 import random
+import base64
+from avatars import AvatarStore
 
 CONFIG_FILE = "hub_config.json"
 
@@ -23,6 +25,7 @@ class ConfigManager:
                     data = json.load(f)
                     config = ConfigManager.get_default()
                     config.update(data)
+                    if config.get("dp_dataurl"): ConfigManager.migrate_avatar(config)
                     return config
             except: pass
         
@@ -37,10 +40,30 @@ class ConfigManager:
             "nickname": "NewUser",
             "bio": "Hey there! I am using Unified Hub.",
             "dp_path": "",
-            "saved_channels": []
+            "avatar": "",
+            "saved_channels": [],
+            "net_engine": "thread",
+            "voice_codec": "adpcm",
+            "voice_rate": 16000,
+            "voice_dtx": True,
+            "audio_frame_ms": 20,
+            "video_delta": True,
+            "video_keyframe_interval": 3.0,
+            "video_fec": 0.2,
+            "file_cache_mb": 4096
         }
 
+    @staticmethod
+    def migrate_avatar(config):
+        # Older configs embed the whole image; move it into the avatar store and keep only its hash
+        try: config["avatar"] = AvatarStore().put(base64.b64decode(config["dp_dataurl"].split(",", 1)[-1]))
+        except: pass
+        config.pop("dp_dataurl", None)
+        ConfigManager.save_config(config)
+
     @staticmethod
     def save_config(config):
+        # dp_dataurl is only ever a UI-side copy of the stored avatar
+        data = {k: v for k, v in config.items() if k != "dp_dataurl"}
         with open(CONFIG_FILE, 'w') as f:
-            json.dump(config, f, indent=4)
\ No newline at end of file
+            json.dump(data, f, indent=4)
\ No newline at end of file
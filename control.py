@@ -0,0 +1,129 @@
+import time
+import zlib
+import itertools
+import threading
+from collections import OrderedDict
+import protocol
+
+COALESCE_WINDOW = 0.02 # Control packets for one peer queued within this window share a datagram
+BATCH_BYTES = 60000 # A batch this big goes out at once instead of waiting for the window
+COMPRESS_MIN = 256 # Smaller bundles rarely shrink
+FRAGMENT_SIZE = 1200 # Same budget as video chunks, so a bundle never relies on IP fragmentation
+MAX_FRAGMENTS = 128
+MAX_BUNDLE = 256 * 1024 # Most a compressed bundle may inflate to
+MAX_PARTIAL = 64 # Bundles being reassembled across all peers
+PARTIAL_TIMEOUT = 5.0
+IDLE_WAIT = 1.0
+
+def split_bundle(body):
+    """Length-prefixed packets -> list of packets; a truncated tail is dropped."""
+    packets, pos = [], 0
+    while pos + protocol.BUNDLE_LEN.size <= len(body):
+        n, = protocol.BUNDLE_LEN.unpack_from(body, pos)
+        pos += protocol.BUNDLE_LEN.size
+        if pos + n > len(body): break
+        packets.append(body[pos:pos + n])
+        pos += n
+    return packets
+
+class ControlChannel:
+    """Batches chat and roster packets per destination into BUNDLE datagrams.
+    Packets queued for a peer within COALESCE_WINDOW go out together, the bundle is zlib-compressed
+    when that pays off, and anything over FRAGMENT_SIZE is split and put back together on arrival.
+    A lone small packet is sent as it is. packet(payload) builds the BUNDLE packet and
+    send(data, target) puts a datagram on the wire; on_pending(delay) is called when a batch opens,
+    for engines that schedule flush() themselves rather than running wait()/flush() on a thread."""
+    def __init__(self, packet, send, window=COALESCE_WINDOW, on_pending=None):
+        self.packet = packet
+        self.send = send
+        self.window = window
+        self.on_pending = on_pending
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.batches = {} # target -> [deadline, packets, bytes]
+        self.partial = OrderedDict() # (addr, bundle id) -> [started, fragment count, {index: fragment}], oldest first
+        self.ids = itertools.count()
+        self.stats = {"packets": 0, "datagrams": 0, "bytes": 0, "wire_bytes": 0}
+
+    def queue(self, target, data, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            batch = self.batches.get(target)
+            opened = batch is None
+            if opened: batch = self.batches[target] = [now + self.window, [], 0]
+            batch[1].append(data)
+            batch[2] += len(data)
+            full = batch[2] >= BATCH_BYTES
+            if full: del self.batches[target]
+            elif opened: self.cond.notify()
+        if full: self.send_batch(target, batch[1])
+        elif opened and self.on_pending: self.on_pending(self.window)
+
+    def flush(self, now=None, force=False):
+        """Sends every batch whose window has closed (all of them with force)."""
+        now = time.time() if now is None else now
+        with self.lock:
+            due = [(t, b) for t, b in self.batches.items() if force or b[0] <= now]
+            for target, _ in due: del self.batches[target]
+        for target, batch in due: self.send_batch(target, batch[1])
+
+    def wait(self, idle=IDLE_WAIT):
+        """Blocks until the next batch is due or a new one opens."""
+        with self.cond:
+            delay = min(b[0] for b in self.batches.values()) - time.time() if self.batches else idle
+            if delay > 0: self.cond.wait(delay)
+
+    def send_batch(self, target, packets):
+        datagrams = self.encode(packets)
+        self.stats["packets"] += len(packets)
+        self.stats["datagrams"] += len(datagrams)
+        self.stats["bytes"] += sum(len(p) for p in packets)
+        self.stats["wire_bytes"] += sum(len(d) for d in datagrams)
+        for data in datagrams: self.send(data, target)
+
+    def encode(self, packets):
+        body = b"".join(protocol.BUNDLE_LEN.pack(len(p)) + p for p in packets)
+        flags = 0
+        if len(body) >= COMPRESS_MIN:
+            packed = zlib.compress(body)
+            if len(packed) < len(body): body, flags = packed, protocol.BUNDLE_ZLIB
+        if len(packets) == 1 and not flags and len(packets[0]) <= FRAGMENT_SIZE: return packets
+        count = -(-len(body) // FRAGMENT_SIZE)
+        if count > MAX_FRAGMENTS: return packets # Only a huge single packet gets here; send it unbundled as before
+        bundle_id = next(self.ids) & 0xFFFF
+        return [self.packet(protocol.BUNDLE_HEADER.pack(flags, bundle_id, i, count) + body[i * FRAGMENT_SIZE:(i + 1) * FRAGMENT_SIZE])
+                for i in range(count)]
+
+    def receive(self, addr, payload, now=None):
+        """One BUNDLE payload -> the packets inside, once every fragment of its bundle is in."""
+        if len(payload) < protocol.BUNDLE_HEADER.size: return []
+        flags, bundle_id, index, count = protocol.BUNDLE_HEADER.unpack_from(payload)
+        body = payload[protocol.BUNDLE_HEADER.size:]
+        if not 0 <= index < count <= MAX_FRAGMENTS: return []
+        if count > 1:
+            now = time.time() if now is None else now
+            with self.lock:
+                self.expire(now)
+                key = (addr, bundle_id)
+                entry = self.partial.get(key)
+                if entry is None: entry = self.partial[key] = [now, count, {}]
+                if entry[1] != count: return []
+                entry[2][index] = body
+                if len(entry[2]) < count:
+                    while len(self.partial) > MAX_PARTIAL: self.partial.popitem(last=False)
+                    return []
+                del self.partial[key]
+            body = b"".join(entry[2][i] for i in range(count))
+        if flags & protocol.BUNDLE_ZLIB:
+            inflate = zlib.decompressobj()
+            try: body = inflate.decompress(body, MAX_BUNDLE)
+            except zlib.error: return []
+            if inflate.unconsumed_tail: return []
+        # No bundles inside bundles
+        return [p for p in split_bundle(body) if len(p) > 1 and p[1] != protocol.BUNDLE]
+
+    def expire(self, now):
+        while self.partial:
+            key, entry = next(iter(self.partial.items()))
+            if now - entry[0] <= PARTIAL_TIMEOUT: break
+            del self.partial[key]
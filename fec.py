@@ -0,0 +1,33 @@
+def parity_count(data_count, overhead):
+    """Parity chunks for a frame of data_count chunks; at least one whenever FEC is on."""
+    if overhead <= 0: return 0
+    return min(data_count, max(1, round(data_count * overhead)))
+
+def parity_chunks(chunks, count):
+    """XOR parity over interleaved groups: parity j covers data chunks j, j + count, j + 2 * count, ...
+    so a burst of consecutive losses lands in different groups. Chunks are zero padded to the first one's size."""
+    if not count: return []
+    size = len(chunks[0])
+    out = []
+    for j in range(count):
+        acc = 0
+        for chunk in chunks[j::count]: acc ^= int.from_bytes(chunk.ljust(size, b"\0"), "big")
+        out.append(acc.to_bytes(size, "big"))
+    return out
+
+def recover(chunks, data_count, parity, frame_size):
+    """chunks: index -> bytes, with parity j at index data_count + j. Rebuilds every group that lost
+    exactly one data chunk, in place. Returns True once all data chunks are present."""
+    size = -(-frame_size // data_count)
+    for j in range(parity):
+        p = chunks.get(data_count + j)
+        if p is None: continue
+        group = range(j, data_count, parity)
+        missing = [i for i in group if i not in chunks]
+        if len(missing) != 1: continue
+        acc = int.from_bytes(p, "big")
+        for i in group:
+            if i in chunks: acc ^= int.from_bytes(chunks[i].ljust(size, b"\0"), "big")
+        i = missing[0]
+        chunks[i] = acc.to_bytes(size, "big")[:min(size, frame_size - i * size)]
+    return all(i in chunks for i in range(data_count))
@@ -0,0 +1,107 @@
+import time
+import threading
+
+MIN_DELAY_MS = 20.0
+MAX_DELAY_MS = 100.0 # Keeps mouth-to-ear under ~150 ms once capture and device buffers are added
+JITTER_MULTIPLIER = 3.0
+DEFAULT_FRAME_MS = 20.0
+RESET_AFTER = 4 # Empty pulls in a row before treating it as the end of a talkspurt
+IDLE_TIMEOUT = 10.0
+MAX_BUFFER_MS = 500.0 # Hard cap on what put() holds, for when nothing is pulling (no output device, playback stopped)
+
+def seq_diff(a, b):
+    """a - b for 32-bit wrapping sequence numbers."""
+    return ((a - b + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+class JitterBuffer:
+    """Per-sender playout buffer for voice frames.
+    Frames are reordered by sequence number and pulled one per playout period. The target delay
+    follows the RFC 3550 interarrival jitter estimate, anything older than the playout point is
+    dropped as late, a single missing frame is concealed by repeating the previous one, and the
+    buffer is trimmed back to the target whenever it runs deeper, so latency can't drift upward."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = {} # seq -> encoded frame
+        self.next_seq = None # None while (re)buffering a talkspurt
+        self.first_arrival = 0.0
+        self.last_arrival = time.time()
+        self.last_transit = None
+        self.last_seq = None
+        self.last_ts = 0
+        self.jitter_ms = 0.0
+        self.frame_ms = DEFAULT_FRAME_MS
+        self.last_frame = None
+        self.concealed = False
+        self.empty_pulls = 0
+        self.late = self.lost = self.trimmed = 0
+
+    @property
+    def target_ms(self):
+        return min(max(self.frame_ms + JITTER_MULTIPLIER * self.jitter_ms, MIN_DELAY_MS), MAX_DELAY_MS)
+
+    @property
+    def target_frames(self):
+        return max(1, int(self.target_ms / self.frame_ms + 0.999))
+
+    def put(self, seq, ts, frame, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.last_arrival = now
+            transit = now * 1000.0 - ts
+            if self.last_transit is not None and self.last_seq is not None and seq_diff(seq, self.last_seq) > 0:
+                self.jitter_ms += (abs(transit - self.last_transit) - self.jitter_ms) / 16.0
+                step = seq_diff(seq, self.last_seq)
+                ts_step = ((ts - self.last_ts) & 0xFFFFFFFF) / step
+                if 0 < ts_step < 200: self.frame_ms += (ts_step - self.frame_ms) / 8.0
+            if self.last_seq is None or seq_diff(seq, self.last_seq) > 0:
+                self.last_transit, self.last_seq, self.last_ts = transit, seq, ts
+
+            if self.next_seq is not None and seq_diff(seq, self.next_seq) < 0:
+                self.late += 1
+                return
+            if not self.frames and self.next_seq is None: self.first_arrival = now
+            self.frames[seq] = frame
+            if len(self.frames) > max(self.target_frames + 2, int(MAX_BUFFER_MS / self.frame_ms)):
+                del self.frames[min(self.frames, key=lambda s: seq_diff(s, seq))]
+                self.trimmed += 1
+
+    def get(self, now=None):
+        """Returns the frame for this playout period, or None for silence."""
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.next_seq is None:
+                if not self.frames or (now - self.first_arrival) * 1000.0 < self.target_ms: return None
+                self.next_seq = min(self.frames, key=lambda s: seq_diff(s, self.last_seq))
+                self.empty_pulls = 0
+            self.trim()
+
+            frame = self.frames.pop(self.next_seq, None)
+            if frame is not None:
+                self.next_seq = (self.next_seq + 1) & 0xFFFFFFFF
+                self.last_frame, self.concealed, self.empty_pulls = frame, False, 0
+                return frame
+            if not self.frames:
+                # Nothing newer either: the talker paused, or the frame is merely late, so wait for it
+                self.empty_pulls += 1
+                if self.empty_pulls >= RESET_AFTER: self.next_seq = None
+                return None
+            self.lost += 1
+            self.next_seq = (self.next_seq + 1) & 0xFFFFFFFF
+            if self.concealed: return None
+            self.concealed = True
+            return self.last_frame
+
+    def trim(self):
+        newest = max(self.frames, key=lambda s: seq_diff(s, self.next_seq), default=None)
+        if newest is None: return
+        depth = seq_diff(newest, self.next_seq) + 1
+        if depth <= self.target_frames + 2: return
+        new_start = (newest - self.target_frames + 1) & 0xFFFFFFFF
+        for seq in [s for s in self.frames if seq_diff(s, new_start) < 0]:
+            del self.frames[seq]
+            self.trimmed += 1
+        self.next_seq = new_start
+
+    @property
+    def idle(self):
+        return time.time() - self.last_arrival > IDLE_TIMEOUT
@@ -1,16 +1,22 @@
 import eel
+import bottle
+import bottle_websocket
 import threading
 import time
-import queue
 import numpy as np
 import tkinter as tk
 from tkinter import filedialog
 import os
 import base64
 
+import protocol
 from config import ConfigManager
-from media import MediaManager
+from avatars import AvatarStore
+from media import MediaManager, TileEncoder
+from screencast import CaptureEngine, WindowTracker
+from thumbnails import ThumbnailCache
 from network import NetworkNode
+from network_async import AsyncNetworkNode
 try:
     from chat_logger import ChatLogger
 except ImportError:
@@ -24,12 +30,56 @@ except ImportError:
 # Initialize Eel to serve files from the 'web' folder
 eel.init('web', allowed_extensions=['.js', '.html', '.css'])
 
+class VideoFeed:
+    """Raw frame bodies pushed to the page over a binary websocket on eel's own server,
+    so video skips base64 and JSON. Frames go out in order since deltas build on each other."""
+    def __init__(self):
+        self.sockets = set()
+        self.lock = threading.Lock()
+
+    def serve(self, ws):
+        with self.lock: self.sockets.add(ws)
+        try:
+            while ws.receive() is not None: pass
+        except Exception: pass
+        finally:
+            with self.lock: self.sockets.discard(ws)
+
+    @property
+    def connected(self):
+        return bool(self.sockets)
+
+    def push(self, frame):
+        with self.lock:
+            for ws in list(self.sockets):
+                try: ws.send(frame, binary=True)
+                except Exception: self.sockets.discard(ws)
+
+video_feed = VideoFeed()
+
+@bottle.route('/video', apply=[bottle_websocket.websocket])
+def video_socket(ws):
+    video_feed.serve(ws)
+
+thumbnails = ThumbnailCache()
+
+@bottle.route('/thumb/<key:re:[0-9a-f]+>.jpg')
+def thumbnail(key):
+    # Chat previews load from here instead of arriving as data URLs with every message
+    path = thumbnails.get(key)
+    if not path: return bottle.HTTPError(404)
+    response = bottle.static_file(os.path.basename(path), root=thumbnails.root, mimetype="image/jpeg")
+    response.set_header("Cache-Control", "max-age=31536000, immutable") # The key changes whenever the file does
+    return response
+
 # Global State
 config = ConfigManager.load_config()
-media = MediaManager()
+avatar_store = AvatarStore()
+media = MediaManager(config.get("audio_frame_ms", 20))
 net = None
 connected = False
 video_sending = False
+video_engine = None
 watching_uid = None
 
 # Hidden Tkinter root so we can trigger native file pickers from the Web UI!
@@ -53,28 +103,29 @@ class WebBridge:
         pass # Fixed: Prevents the AttributeError crash! UI handles this natively.
 
     def on_chat_received(self, sender_uid, sender_nick, message):
-        b64_img = ""
+        dp_b64, img_url = self.chat_media(sender_uid, message)
+        eel.js_on_chat_received(sender_uid, sender_nick, message, dp_b64, img_url)()
+
+    def on_history_page(self, rows, has_more, older, last=True):
+        messages = []
+        for r in rows:
+            dp_b64, img_url = self.chat_media(r["uid"], r["msg"])
+            messages.append({"id": r["id"], "uid": r["uid"], "nick": r["nick"], "msg": r["msg"], "dp": dp_b64, "img": img_url, "ts": r["ts"]})
+        eel.js_history_page(messages, has_more, older, last)()
+
+    def chat_media(self, sender_uid, message):
+        img_url = ""
         
         if message.startswith("[IMAGE_PREVIEW]|"):
-            path = message.split("|", 1)[1]
-            try:
-                with open(path, "rb") as f:
-                    b64_img = "data:image/jpeg;base64," + base64.b64encode(f.read()).decode()
-            except: pass
+            img_url = thumbnails.url(message.split("|", 1)[1])
         elif message.startswith("[VIDEO_PREVIEW]|"):
             parts = message.split("|")
             thumb_path = parts[2] if len(parts)>2 else ""
-            try:
-                if os.path.exists(thumb_path):
-                    with open(thumb_path, "rb") as f:
-                        b64_img = "data:image/jpeg;base64," + base64.b64encode(f.read()).decode()
-            except: pass
+            if thumb_path: img_url = thumbnails.url(thumb_path)
             
-        dp_b64 = ""
-        if net and sender_uid in net.dp_cache: dp_b64 = net.dp_cache[sender_uid]
-        elif sender_uid == config["uid"]: dp_b64 = config.get("dp_dataurl", "")
-
-        eel.js_on_chat_received(sender_uid, sender_nick, message, dp_b64, b64_img)()
+        dp_b64 = net.dp_b64(sender_uid) if net else ""
+        if not dp_b64 and sender_uid == config["uid"]: dp_b64 = my_dp_dataurl()
+        return dp_b64, img_url
 
     def update_user_list_ui(self, parsed_users):
         users = []
@@ -86,15 +137,19 @@ class WebBridge:
                 "isLive": u[2] == "1",
                 "dp": u[3],
                 "bio": u[4] if len(u)>4 else "Hey there!",
-                "isHost": net.connected_peers.get(u[0], {}).get("is_host", False) if net else False
+                "isHost": bool(u[5]) if len(u)>5 else False
             })
         eel.js_update_user_list(users)()
 
     def set_user_speaking(self, uid):
         eel.js_set_user_speaking(uid)()
 
-    def render_video_frame(self, jpeg_bytes):
-        b64 = base64.b64encode(jpeg_bytes).decode()
+    def on_transfer_progress(self, direction, filename, percent):
+        eel.js_transfer_progress(direction, filename, percent) # Fire-and-forget, called from transfer loops
+
+    def render_video_frame(self, frame):
+        if video_feed.connected: return video_feed.push(frame)
+        b64 = base64.b64encode(frame).decode() # Fallback until the page's video socket is up
         eel.js_render_video(b64)()
         
     def on_room_accepted(self, code, name):
@@ -102,6 +157,16 @@ class WebBridge:
 
 bridge = WebBridge()
 
+NETWORK_ENGINES = {"thread": NetworkNode, "asyncio": AsyncNetworkNode}
+
+def my_dp_dataurl():
+    b64 = avatar_store.b64(config.get("avatar", ""))
+    return "data:image/jpeg;base64," + b64 if b64 else ""
+
+def make_network_node(engine=None):
+    engine = engine or config.get("net_engine", "thread")
+    return NETWORK_ENGINES.get(engine, NetworkNode)(bridge, config)
+
 # --- EEL PYTHON ENDPOINTS EXPOSED TO JAVASCRIPT ---
 
 @eel.expose
@@ -130,7 +195,7 @@ def py_play_tone(tone_type):
 
 @eel.expose
 def py_get_config():
-    return config
+    return dict(config, dp_dataurl=my_dp_dataurl()) # The UI still works with data URLs; only the hash is saved
 
 @eel.expose
 def py_save_config(new_config):
@@ -159,7 +224,7 @@ def py_change_avatar():
             img.save(buf, format="JPEG", quality=85)
             b64 = "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode()
             
-            config["dp_dataurl"] = b64
+            config["avatar"] = avatar_store.put(buf.getvalue())
             config["dp_path"] = path 
             ConfigManager.save_config(config)
             
@@ -169,11 +234,11 @@ def py_change_avatar():
     return None
 
 @eel.expose
-def py_start_host(room_name, port, pwd, previous_code=None, channel_uid=None):
+def py_start_host(room_name, port, pwd, previous_code=None, channel_uid=None, engine=None):
     global net, connected, media
     if net: net.shutdown()
     media.start_audio()
-    net = NetworkNode(bridge, config)
+    net = make_network_node(engine)
     
     if previous_code:
         net.room_code = previous_code
@@ -185,43 +250,40 @@ def py_start_host(room_name, port, pwd, previous_code=None, channel_uid=None):
             
     net.start_host(int(port), room_name, pwd)
     
-    if net.chat_logger:
-        for msg in net.chat_logger.history:
-            bridge.on_chat_received(msg["uid"], msg["nick"], msg["msg"])
+    net.show_history()
             
     connected = True
     start_threads()
     return net.room_code
 
 @eel.expose
-def py_start_client(ip, port, pwd):
+def py_start_client(ip, port, pwd, engine=None):
     global net, connected, media
     if net: net.shutdown()
     media.start_audio()
-    net = NetworkNode(bridge, config)
+    net = make_network_node(engine)
     net.start_client(ip, int(port), pwd)
     connected = True
     start_threads()
 
 @eel.expose
 def py_disconnect(shutdown=True):
-    global connected, net, video_sending, watching_uid
+    global connected, net, watching_uid
     connected = False
-    video_sending = False
+    stop_video_engine()
     watching_uid = None
     if net:
         if not net.is_host or shutdown:
             net.shutdown()
             net = None
         else:
-            msg = f"T|{config['uid']}|{config['nickname']}|Host has minimized to Lobby. Server is still running."
-            net.broadcast(msg.encode())
+            net.broadcast(net.packet(protocol.TEXT, protocol.fields(0, config['nickname'], "Host has minimized to Lobby. Server is still running.")))
     media.stop_audio()
 
 @eel.expose
 def py_migrate_server():
     if net and getattr(net, 'sec_host_uid', None):
-        net.broadcast(b"MIGRATE|" + net.sec_host_uid.encode())
+        net.broadcast(net.packet(protocol.MIGRATE, net.sec_host_uid))
         time.sleep(0.3)
         py_disconnect(shutdown=True)
         return True
@@ -231,14 +293,14 @@ def py_migrate_server():
 def py_request_secondary(uid):
     if net and net.is_host:
         if uid in net.connected_peers:
-            net.send_packet(b"REQ_SEC|" + net.uid.encode(), net.connected_peers[uid]["addr"])
+            net.send_packet(net.packet(protocol.REQ_SEC), net.connected_peers[uid]["addr"])
             nick = net.connected_peers[uid]["nick"]
             bridge.on_chat_received("SYSTEM", "System", f"Requested {nick} to act as Secondary Host.")
 
 @eel.expose
 def py_accept_secondary():
     if net:
-        net.send_packet(b"SEC_ACCEPT|" + config["uid"].encode())
+        net.send_packet(net.packet(protocol.SEC_ACCEPT))
         bridge.on_chat_received("SYSTEM", "System", "✅ You accepted Secondary Host duties.")
 
 @eel.expose
@@ -249,6 +311,7 @@ def py_reenter_vc():
     media.start_audio()
     start_threads()
     net.update_user_list()
+    if net.is_host: net.show_history()
     return {"name": net.room_name, "code": net.room_code}
 
 @eel.expose
@@ -257,6 +320,17 @@ def py_send_chat(text):
         net.send_text(text)
         bridge.on_chat_received(config["uid"], config["nickname"], text)
 
+@eel.expose
+def py_load_older_history():
+    if net: net.load_older_history()
+
+@eel.expose
+def py_search_chat(query, uid="", since=None, until=None, before=None, limit=20):
+    """Searches the room's chat log, newest first; since/until are unix times, before pages on from a result id.
+    Only the host keeps a log, so guests get no results."""
+    if not net or not getattr(net, "chat_logger", None): return []
+    return net.chat_logger.search(query, uid or None, since, until, before, max(1, min(int(limit), 100)))
+
 @eel.expose
 def py_open_file(path):
     try:
@@ -343,11 +417,8 @@ def py_get_video_sources():
 def py_toggle_stream(res_type, fps_val, source_id="monitor:1"):
     global video_sending, net
     if video_sending:
-        video_sending = False
-        if net:
-            net.connected_peers[net.uid]["is_live"] = False
-            net.broadcast(f"STREAM_STOP|{net.uid}".encode())
-            net.update_user_list()
+        stop_video_engine()
+        if net: net.set_streaming(False)
         return False
     
     target_width = 1280
@@ -362,101 +433,104 @@ def py_toggle_stream(res_type, fps_val, source_id="monitor:1"):
         src_type, src_val = source_id.split(":", 1)
     
     video_sending = True
-    if net:
-        net.connected_peers[net.uid]["is_live"] = True
-        net.broadcast(f"STREAM_START|{net.uid}".encode())
-        net.update_user_list()
+    if net: net.set_streaming(True)
         
-    threading.Thread(target=video_sender_thread, args=(target_width, fps, src_type, src_val), daemon=True).start()
+    start_video_engine(target_width, fps, src_type, src_val)
     return True
 
 @eel.expose
 def py_watch_stream(uid):
     global watching_uid
     watching_uid = uid
+    if net: net.watch_stream(uid)
+
+@eel.expose
+def py_set_user_volume(uid, volume):
+    media.set_user_volume(uid, volume)
+
+@eel.expose
+def py_set_user_muted(uid, muted):
+    media.set_user_muted(uid, muted)
 
 @eel.expose
 def py_stop_watching():
     global watching_uid
     watching_uid = None
+    if net: net.stop_watching()
 
 # --- BACKGROUND THREADS ---
 def start_threads():
     threading.Thread(target=audio_sender_thread, daemon=True).start()
-    threading.Thread(target=audio_player_thread, daemon=True).start()
     threading.Thread(target=glow_ring_loop, daemon=True).start()
 
 def audio_sender_thread():
+    reader = media.capture_reader()
     while connected:
-        if net:
-            chunk = media.get_audio_chunk()
-            if chunk:
-                try: net.send_audio(chunk)
-                except AttributeError: pass
-        time.sleep(0.01)
-
-def audio_player_thread():
-    while connected:
-        if not net:
-            time.sleep(0.1)
+        chunk = reader.read(timeout=0.5)
+        if net and chunk:
+            frame = media.encode_voice(chunk, protocol.VOICE_CODECS.get(net.voice_codec, 0), net.voice_rate, config.get("voice_dtx", True))
+            try:
+                if frame: net.send_audio(*frame)
+            except AttributeError: pass
+
+def pull_voice_frames():
+    # Called from the audio output callback once per playout period; the jitter buffers absorb network timing
+    frames = []
+    if not connected or not net: return frames
+    for uid, buf in list(net.jitter_buffers.items()):
+        if buf.idle:
+            net.jitter_buffers.pop(uid, None)
+            media.forget_user(uid)
             continue
-        try:
-            chunk, sender_uid = net.audio_queue.get(timeout=1)
-            if not getattr(media, 'is_deafened', False):
-                media.play_audio_chunk(chunk)
-        except queue.Empty: continue
-        except AttributeError: pass
+        frame = buf.get()
+        samples = media.decode_voice(uid, *frame) if frame else media.comfort_noise(uid)
+        if samples is not None: frames.append((uid, samples))
+    return frames
+
+media.voice_source = pull_voice_frames
 
 def glow_ring_loop():
+    reader = media.capture_reader()
     while connected:
         if net and not media.is_mic_muted:
-            chunk = media.get_audio_chunk()
+            chunk = reader.latest()
             if chunk and max(np.frombuffer(chunk, dtype=np.int16)) > 500:
                 bridge.set_user_speaking(net.uid)
         time.sleep(0.1)
 
-def video_sender_thread(target_width, fps, source_type, source_val):
-    global video_sending
+def start_video_engine(target_width, fps, source_type, source_val):
+    global video_engine
     frame_id = 0
-    sleep_time = 1.0 / fps
-    while connected and video_sending:
-        if not net: break
-        start_time = time.time()
-        
-        region = None
-        monitor_idx = 1
-        
-        if source_type == "monitor":
-            try: monitor_idx = int(source_val)
-            except: monitor_idx = 1
-        elif source_type == "window" and gw:
-            try:
-                windows = gw.getWindowsWithTitle(source_val)
-                if not windows:
-                    video_sending = False
-                    bridge.on_chat_received("SYSTEM", "System", "Stream ended: Window was closed.")
-                    if net:
-                        net.connected_peers[net.uid]["is_live"] = False
-                        net.broadcast(f"STREAM_STOP|{net.uid}".encode())
-                        net.update_user_list()
-                    break
-                w = windows[0]
-                if w.width > 0 and w.height > 0:
-                    region = {"top": w.top, "left": w.left, "width": w.width, "height": w.height}
-            except: pass
-                
-        if source_type == "window" and not region:
-            time.sleep(sleep_time)
-            continue
 
-        jpeg_bytes = media.capture_screen_jpeg(max_width=target_width, region=region, monitor_idx=monitor_idx)
-        if jpeg_bytes:
-            try: net.send_video_frame(frame_id, jpeg_bytes)
-            except Exception: break
-            if watching_uid == net.uid: bridge.render_video_frame(jpeg_bytes)
-            frame_id = (frame_id + 1) % 10000 
-        elapsed = time.time() - start_time
-        if elapsed < sleep_time: time.sleep(sleep_time - elapsed)
+    def send(body):
+        nonlocal frame_id
+        if not net: raise ConnectionError
+        net.send_video_frame(frame_id, body)
+        if watching_uid == net.uid: bridge.render_video_frame(body)
+        frame_id = (frame_id + 1) % protocol.VIDEO_FRAME_IDS
+
+    def on_end(reason):
+        global video_sending
+        video_sending = False
+        bridge.on_chat_received("SYSTEM", "System", reason)
+        if net: net.set_streaming(False)
+
+    monitor_idx, tracker = 1, None
+    if source_type == "monitor":
+        try: monitor_idx = int(source_val)
+        except: monitor_idx = 1
+    elif source_type == "window": tracker = WindowTracker(source_val)
+
+    encoder = TileEncoder(keyframe_interval=config.get("video_keyframe_interval", 3.0), delta=config.get("video_delta", True))
+    audience = lambda: (net.stream_viewer_count + (1 if watching_uid == net.uid else 0)) if net else 0
+    feedback = lambda: net.recent_video_reports() if net else []
+    video_engine = CaptureEngine(encoder, send, fps, target_width, monitor_idx, tracker, audience, on_end, feedback)
+    video_engine.start()
+
+def stop_video_engine():
+    global video_sending
+    video_sending = False
+    if video_engine: video_engine.stop()
 
 if __name__ == "__main__":
     try:
@@ -1,60 +1,454 @@
 import cv2
+import time
+import threading
+import struct
+import functools
 import numpy as np
 import mss
 import pyaudio
 from PIL import Image
+import protocol
 
 AUDIO_FORMAT = pyaudio.paInt16
 AUDIO_CHANNELS = 1
-AUDIO_CHUNK = 1024
+AUDIO_FRAME_MS = 20
+VOICE_RATE = 16000
+VAD_THRESHOLD_DB = 9.0 # Over the noise floor
+VAD_MIN_DB = -55.0 # dBov; anything quieter is never speech
+VAD_NOISY_ZCR = 0.35
+VAD_FLOOR_RISE = 1.0 # dB per second the floor may creep up while "speech" persists
+VAD_HANGOVER = 0.3
+CN_INTERVAL = 0.5 # Comfort-noise refresh while DTX is suppressing silence
+CAPTURE_RING_FRAMES = 64
+PLAYOUT_SLACK = 8 # Samples a resampled period may run short or long before it costs a whole extra period of latency
+VIDEO_TILE = 64
+VIDEO_QUALITY = 40
+KEYFRAME_INTERVAL = 3.0
+KEYFRAME_DIRTY = 0.5 # Past this share of dirty tiles one full JPEG is cheaper than many small ones
 
-class MediaManager:
+# --- Voice codecs. Ids match protocol.VOICE_CODECS; every frame decodes on its own so loss and concealment stay simple ---
+
+class PcmCodec:
+    codec_id = 0
+    def encode(self, samples): return samples.astype('<i2').tobytes()
+    def decode(self, data): return np.frombuffer(data, dtype='<i2', count=len(data) // 2).astype(np.int16)
+
+class MuLawCodec:
+    """G.711 mu-law, 8 bits per sample, table-free encode and a 256-entry decode table."""
+    codec_id = 1
+    BIAS = 0x84
+    CLIP = 32635
+
+    def __init__(self):
+        u = ~np.arange(256, dtype=np.int32) & 0xFF
+        magnitude = (((u & 0x0F) << 3) + self.BIAS << ((u >> 4) & 0x07)) - self.BIAS
+        self.table = np.where(u & 0x80, -magnitude, magnitude).astype(np.int16)
+
+    def encode(self, samples):
+        x = samples.astype(np.int32)
+        sign = (x < 0).astype(np.int32) << 7
+        x = np.minimum(np.abs(x), self.CLIP) + self.BIAS
+        exponent = np.clip(np.frexp(x)[1] - 8, 0, 7)
+        mantissa = (x >> (exponent + 3)) & 0x0F
+        return (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8).tobytes()
+
+    def decode(self, data):
+        return self.table[np.frombuffer(data, dtype=np.uint8)]
+
+ADPCM_STEPS = [
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66, 73, 80, 88, 97,
+    107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796,
+    876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871,
+    5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623,
+    27086, 29794, 32767]
+ADPCM_INDEX = [-1, -1, -1, -1, 2, 4, 6, 8] * 2
+
+class AdpcmCodec:
+    """IMA ADPCM, 4 bits per sample. The predictor recurrence is inherently sequential, so the per-sample
+    loop runs over plain ints; nibble packing is vectorized. Each frame carries its starting predictor,
+    step index and sample count, and the encoder carries its state over between frames."""
+    codec_id = 2
+    HEADER = struct.Struct("<hBH")
+
+    def __init__(self):
+        self.predictor = 0
+        self.index = 0
+
+    def encode(self, samples):
+        header = self.HEADER.pack(self.predictor, self.index, len(samples))
+        predictor, index = self.predictor, self.index
+        codes = bytearray(len(samples) + (len(samples) & 1))
+        for i, sample in enumerate(samples.tolist()):
+            step = ADPCM_STEPS[index]
+            diff = sample - predictor
+            code = 8 if diff < 0 else 0
+            if code: diff = -diff
+            delta = step >> 3
+            if diff >= step: code |= 4; diff -= step; delta += step
+            step >>= 1
+            if diff >= step: code |= 2; diff -= step; delta += step
+            step >>= 1
+            if diff >= step: code |= 1; delta += step
+            predictor = max(-32768, min(32767, predictor - delta if code & 8 else predictor + delta))
+            index = max(0, min(88, index + ADPCM_INDEX[code]))
+            codes[i] = code
+        self.predictor, self.index = predictor, index
+        nibbles = np.frombuffer(bytes(codes), dtype=np.uint8)
+        return header + (nibbles[0::2] | (nibbles[1::2] << 4)).tobytes()
+
+    def decode(self, data):
+        if len(data) < self.HEADER.size: return None
+        predictor, index, count = self.HEADER.unpack_from(data)
+        packed = np.frombuffer(data, dtype=np.uint8, offset=self.HEADER.size)
+        nibbles = np.empty(len(packed) * 2, dtype=np.uint8)
+        nibbles[0::2], nibbles[1::2] = packed & 0x0F, packed >> 4
+        out = np.empty(min(count, len(nibbles)), dtype=np.int16)
+        index = min(index, 88)
+        for i, code in enumerate(nibbles[:len(out)].tolist()):
+            step = ADPCM_STEPS[index]
+            delta = step >> 3
+            if code & 4: delta += step
+            if code & 2: delta += step >> 1
+            if code & 1: delta += step >> 2
+            predictor = max(-32768, min(32767, predictor - delta if code & 8 else predictor + delta))
+            index = max(0, min(88, index + ADPCM_INDEX[code]))
+            out[i] = predictor
+        return out
+
+@functools.lru_cache(maxsize=8)
+def lowpass_taps(src_rate, dst_rate, taps=31):
+    """Windowed-sinc anti-alias filter with its cutoff just under the target Nyquist."""
+    cutoff = 0.45 * dst_rate / src_rate
+    n = np.arange(taps) - (taps - 1) / 2
+    h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+    return (h / h.sum()).astype(np.float32)
+
+class Resampler:
+    """Streaming linear-interpolation resampler. The fractional read position and the previous chunk's
+    last sample carry over, so chunk boundaries stay seamless whatever the chunk size; going down in
+    rate, the input is low-passed first with filter history kept the same way."""
+    def __init__(self, src_rate, dst_rate):
+        self.src_rate, self.dst_rate = src_rate, dst_rate
+        self.step = src_rate / dst_rate
+        self.pos = 1.0
+        self.last = 0.0
+        self.taps = lowpass_taps(src_rate, dst_rate) if dst_rate < src_rate else None
+        self.history = np.zeros(len(self.taps) - 1, dtype=np.float32) if self.taps is not None else None
+
+    def process(self, samples):
+        x = samples.astype(np.float32)
+        if self.src_rate == self.dst_rate: return samples.astype(np.int16)
+        if self.taps is not None:
+            padded = np.concatenate((self.history, x))
+            self.history = padded[len(x):]
+            x = np.convolve(padded, self.taps, mode='valid')
+        x = np.concatenate(([self.last], x))
+        end = len(x) - 1
+        count = int((end - self.pos) // self.step) + 1 if end >= self.pos else 0
+        positions = self.pos + np.arange(count) * self.step
+        out = np.interp(positions, np.arange(len(x)), x)
+        self.pos += count * self.step - end
+        self.last = x[-1]
+        return np.clip(np.round(out), -32768, 32767).astype(np.int16)
+
+class VoiceActivityDetector:
+    """Energy and zero-crossing voice detector with an adaptive noise floor and hangover.
+    The floor follows quiet frames quickly and only creeps up under steady noise, so a fan stops
+    counting as speech after a few seconds; the hangover keeps word endings from being clipped."""
+    def __init__(self):
+        self.floor_db = -60.0
+        self.level_db = -100.0
+        self.hangover = 0.0
+
+    def process(self, samples, seconds):
+        x = samples.astype(np.float32)
+        self.level_db = 10 * np.log10(float(np.dot(x, x)) / max(len(x), 1) / 32768.0 ** 2 + 1e-12)
+        zcr = np.count_nonzero(np.diff(np.signbit(x))) / max(len(x) - 1, 1)
+        above = self.level_db - self.floor_db
+        # Hiss crosses zero constantly without rising far above the floor
+        speech = self.level_db > VAD_MIN_DB and above > VAD_THRESHOLD_DB and not (zcr > VAD_NOISY_ZCR and above < 2 * VAD_THRESHOLD_DB)
+        if speech:
+            self.hangover = VAD_HANGOVER
+            self.floor_db += min(above, VAD_FLOOR_RISE * seconds)
+        else:
+            self.hangover = max(self.hangover - seconds, 0.0)
+            self.floor_db += (self.level_db - self.floor_db) * (0.5 if above < 0 else 0.1)
+        return speech or self.hangover > 0
+
+class FrameRing:
+    """Single-writer ring of captured frames. The writer never waits on readers: it fills the next slot
+    and bumps a counter, taking the condition only to wake sleepers. Each reader has its own cursor, so
+    consumers never steal frames from each other; one that falls a whole ring behind skips ahead."""
+    def __init__(self, capacity=CAPTURE_RING_FRAMES):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.written = 0
+        self.cond = threading.Condition()
+
+    def write(self, frame):
+        self.slots[self.written % self.capacity] = frame
+        self.written += 1
+        with self.cond: self.cond.notify_all()
+
+    def reader(self):
+        return RingReader(self)
+
+class RingReader:
+    def __init__(self, ring):
+        self.ring = ring
+        self.cursor = ring.written
+
+    def read(self, timeout=None):
+        """Next frame for this reader, waiting up to timeout; None if nothing arrived."""
+        ring = self.ring
+        if self.cursor == ring.written:
+            with ring.cond: ring.cond.wait_for(lambda: self.cursor != ring.written, timeout)
+        if self.cursor == ring.written: return None
+        if ring.written - self.cursor > ring.capacity: self.cursor = ring.written - ring.capacity
+        frame = ring.slots[self.cursor % ring.capacity]
+        self.cursor += 1
+        return frame
+
+    def latest(self):
+        """Newest frame, skipping anything older; for consumers that only care about now."""
+        written = self.ring.written
+        if written == self.cursor: return None
+        self.cursor = written
+        return self.ring.slots[(written - 1) % self.ring.capacity]
+
+# --- Screen share ---
+
+class ScreenGrabber:
+    """One mss handle kept for a whole stream. mss keeps per-thread state, so use it on the thread that made it."""
     def __init__(self):
+        self.sct = mss.mss()
+
+    def grab(self, region=None, monitor_idx=1):
+        """Raw BGRA frame of the region or monitor; a view of the mss buffer, not a copy."""
+        if not region:
+            if monitor_idx >= len(self.sct.monitors): monitor_idx = 1
+            region = self.sct.monitors[monitor_idx]
+        return np.asarray(self.sct.grab(region))
+
+    def close(self):
+        try: self.sct.close()
+        except: pass
+
+def scale_frame(img, max_width):
+    """BGRA capture to a BGR frame no wider than max_width."""
+    height, width = img.shape[:2]
+    if width > max_width:
+        scale = max_width / width
+        img = cv2.resize(img, (int(width * scale), int(height * scale)))
+    return cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+
+class TileEncoder:
+    """Delta encoder for screen share. Each frame is compared with the previous one tile by tile and
+    only horizontal runs of changed tiles are JPEG-encoded, as regions the viewer paints over its canvas.
+    Keyframes (every region covering the frame) go out periodically, on a size change or when forced,
+    so late joiners and viewers who lost a frame resync."""
+    def __init__(self, tile=VIDEO_TILE, keyframe_interval=KEYFRAME_INTERVAL, delta=True):
+        self.tile = tile
+        self.keyframe_interval = keyframe_interval
+        self.delta = delta
+        self.prev = None
+        self.last_key = 0.0
+        self.force_key = False
+
+    def encode(self, frame, quality=VIDEO_QUALITY):
+        """Returns the frame body for send_video_frame, or None when nothing changed."""
+        height, width = frame.shape[:2]
+        now = time.time()
+        key = (not self.delta or self.force_key or self.prev is None or self.prev.shape != frame.shape
+               or now - self.last_key >= self.keyframe_interval)
+        regions = None if key else self.dirty_regions(frame)
+        self.prev = frame
+        if regions is None:
+            key, regions = True, [(0, 0, width, height)]
+            self.force_key, self.last_key = False, now
+        elif not regions: return None
+
+        params = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)]
+        out = [protocol.VFRAME_HEADER.pack(protocol.VFRAME_KEY if key else 0, width, height)]
+        for x, y, w, h in regions:
+            ok, jpg = cv2.imencode('.jpg', frame[y:y + h, x:x + w], params)
+            if not ok: return None
+            out.append(protocol.VREGION_HEADER.pack(x, y, w, h, len(jpg)))
+            out.append(jpg.tobytes())
+        return b"".join(out)
+
+    def dirty_regions(self, frame):
+        """Changed areas as (x, y, w, h) runs of tiles, or None when a keyframe is the better deal."""
+        t = self.tile
+        height, width = frame.shape[:2]
+        # OR-reduce the byte-wise diff over tile spans; reduceat copes with partial edge tiles
+        changed = (frame != self.prev).reshape(height, -1)
+        changed = np.logical_or.reduceat(changed, np.arange(0, changed.shape[1], t * frame.shape[2]), axis=1)
+        dirty = np.logical_or.reduceat(changed, np.arange(0, height, t), axis=0)
+        if dirty.mean() > KEYFRAME_DIRTY: return None
+
+        regions = []
+        for r in np.flatnonzero(dirty.any(axis=1)):
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], dirty[r].view(np.int8), [0]))))
+            y, h = r * t, min(t, height - r * t)
+            for start, end in zip(edges[0::2], edges[1::2]):
+                regions.append((start * t, y, min(end * t, width) - start * t, h))
+        return regions
+
+class MediaManager:
+    def __init__(self, frame_ms=AUDIO_FRAME_MS):
         self.p = pyaudio.PyAudio()
+        self.frame_ms = min(max(int(frame_ms), 5), 60)
         self.audio_in_stream = None
         self.audio_out_stream = None
+        self.capture_ring = FrameRing()
         self.is_mic_muted = False
         self.is_deafened = False
+        self.rate = 44100
+        self.user_volumes = {} # uid -> playback gain, 1.0 = unchanged
+        self.muted_users = set()
+        self.codecs = {codec.codec_id: codec for codec in (PcmCodec(), MuLawCodec(), AdpcmCodec())}
+        self.tx_resampler = None
+        self.vad = VoiceActivityDetector()
+        self.last_cn_sent = 0.0
+        self.cn_levels = {} # sender uid -> comfort noise level (-dBov) while they are silent
+        self.rx_resamplers = {} # sender uid -> Resampler to the device rate
+        self.voice_source = None # Set by the app: returns [(uid, samples)] for one playout period
+        self.playout = np.zeros(0, dtype=np.int16)
         
     def start_audio(self):
+        if self.p is None: self.p = pyaudio.PyAudio()
         rates_to_try = [44100, 48000]
         for rate in rates_to_try:
             mic_ok = False
             speaker_ok = False
             
+            frames = rate * self.frame_ms // 1000
             if self.audio_in_stream is None:
                 try:
-                    self.audio_in_stream = self.p.open(format=AUDIO_FORMAT, channels=AUDIO_CHANNELS, rate=rate, input=True, frames_per_buffer=AUDIO_CHUNK)
+                    self.audio_in_stream = self.p.open(format=AUDIO_FORMAT, channels=AUDIO_CHANNELS, rate=rate, input=True, frames_per_buffer=frames, stream_callback=self.on_capture)
                     mic_ok = True
                 except: pass
                     
             if self.audio_out_stream is None:
                 try:
-                    self.audio_out_stream = self.p.open(format=AUDIO_FORMAT, channels=AUDIO_CHANNELS, rate=rate, output=True, frames_per_buffer=AUDIO_CHUNK)
+                    self.audio_out_stream = self.p.open(format=AUDIO_FORMAT, channels=AUDIO_CHANNELS, rate=rate, output=True, frames_per_buffer=frames, stream_callback=self.on_playout)
                     speaker_ok = True
                 except: pass
             
             if mic_ok or speaker_ok:
-                print(f"Audio initialized at {rate} Hz (Mic: {mic_ok}, Speaker: {speaker_ok}).")
+                self.rate = rate
+                print(f"Audio initialized at {rate} Hz, {self.frame_ms} ms frames (Mic: {mic_ok}, Speaker: {speaker_ok}).")
                 break
                 
     def stop_audio(self):
+        in_stream, out_stream = self.audio_in_stream, self.audio_out_stream
+        self.audio_in_stream = self.audio_out_stream = None
         try:
-            if self.audio_in_stream: self.audio_in_stream.stop_stream(); self.audio_in_stream.close()
-            if self.audio_out_stream: self.audio_out_stream.stop_stream(); self.audio_out_stream.close()
+            if in_stream: in_stream.stop_stream(); in_stream.close()
+            if out_stream: out_stream.stop_stream(); out_stream.close()
             self.p.terminate()
         except: pass
+        self.p = None
 
-    def get_audio_chunk(self):
-        if self.audio_in_stream and not self.is_mic_muted:
-            try: return self.audio_in_stream.read(AUDIO_CHUNK, exception_on_overflow=False)
-            except: pass
-        return None
+    @property
+    def frame_samples(self):
+        return self.rate * self.frame_ms // 1000
 
-    def play_audio_chunk(self, chunk):
-        if self.audio_out_stream and not getattr(self, 'is_deafened', False):
-            try: self.audio_out_stream.write(chunk)
-            except: pass
+    def on_capture(self, in_data, frame_count, time_info, status):
+        # PortAudio's thread and the only reader of the microphone: hand the frame to the ring and return
+        if not self.is_mic_muted: self.capture_ring.write(in_data)
+        return (None, pyaudio.paContinue)
+
+    def on_playout(self, in_data, frame_count, time_info, status):
+        try: out = self.next_playout(frame_count)
+        except Exception: out = np.zeros(frame_count, dtype=np.int16) # An exception here would stop the stream for good
+        return (out.tobytes(), pyaudio.paContinue)
+
+    def next_playout(self, frame_count):
+        """Pulls mixed playout periods from voice_source until the device buffer can be filled."""
+        while len(self.playout) < frame_count:
+            short = frame_count - len(self.playout)
+            if len(self.playout) and short <= PLAYOUT_SLACK:
+                self.playout = np.concatenate((self.playout, np.repeat(self.playout[-1:], short)))
+                break
+            frames = self.voice_source() if self.voice_source else []
+            mixed = self.mix_frames(frames) if frames else None
+            if mixed is None: mixed = np.zeros(self.frame_samples, dtype=np.int16)
+            self.playout = np.concatenate((self.playout, mixed))
+        out, self.playout = self.playout[:frame_count], self.playout[frame_count:]
+        if len(self.playout) <= PLAYOUT_SLACK: self.playout = self.playout[:0]
+        # Deafened still drains the jitter buffers so nothing stale plays on undeafen
+        return np.zeros(frame_count, dtype=np.int16) if self.is_deafened else out
+
+    def capture_reader(self):
+        return self.capture_ring.reader()
+
+    def encode_voice(self, chunk, codec_id, voice_rate=VOICE_RATE, dtx=True):
+        """Turns a captured chunk into (codec id, sample rate, payload) for NetworkNode.send_audio,
+        or None while DTX holds back silence. Silence only goes out as a periodic comfort-noise level."""
+        samples = np.frombuffer(chunk, dtype=np.int16)
+        rate = voice_rate if voice_rate and voice_rate < self.rate else self.rate
+        if dtx and not self.vad.process(samples, len(samples) / self.rate):
+            now = time.time()
+            if now - self.last_cn_sent < CN_INTERVAL: return None
+            self.last_cn_sent = now
+            return protocol.COMFORT_NOISE, rate, bytes([int(min(max(-self.vad.floor_db, 0), 127))])
+        self.last_cn_sent = 0.0
+        if rate != self.rate:
+            if not self.tx_resampler or (self.tx_resampler.src_rate, self.tx_resampler.dst_rate) != (self.rate, rate):
+                self.tx_resampler = Resampler(self.rate, rate)
+            samples = self.tx_resampler.process(samples)
+        codec = self.codecs.get(codec_id, self.codecs[PcmCodec.codec_id])
+        return codec.codec_id, rate, codec.encode(samples)
+
+    def decode_voice(self, uid, codec_id, rate, payload):
+        """Returns int16 samples at the device rate, or None for an unknown codec."""
+        if codec_id == protocol.COMFORT_NOISE:
+            if payload: self.cn_levels[uid] = payload[0]
+            return self.comfort_noise(uid)
+        self.cn_levels.pop(uid, None)
+        codec = self.codecs.get(codec_id)
+        samples = codec.decode(payload) if codec else None
+        if samples is None or not rate: return None
+        if rate == self.rate: return samples
+        resampler = self.rx_resamplers.get(uid)
+        if not resampler or (resampler.src_rate, resampler.dst_rate) != (rate, self.rate):
+            resampler = self.rx_resamplers[uid] = Resampler(rate, self.rate)
+        return resampler.process(samples)
+
+    def comfort_noise(self, uid):
+        """Low-level noise standing in for a DTX-silent sender, so the channel doesn't sound dead."""
+        level = self.cn_levels.get(uid)
+        if level is None: return None
+        noise = np.random.normal(0.0, 32768.0 * 10 ** (-level / 20.0), self.frame_samples)
+        return np.clip(noise, -32768, 32767).astype(np.int16)
+
+    def forget_user(self, uid):
+        self.rx_resamplers.pop(uid, None)
+        self.cn_levels.pop(uid, None)
+
+    def set_user_volume(self, uid, volume):
+        self.user_volumes[uid] = min(max(float(volume), 0.0), 2.0)
+
+    def set_user_muted(self, uid, muted):
+        if muted: self.muted_users.add(uid)
+        else: self.muted_users.discard(uid)
+
+    def mix_frames(self, frames):
+        """Sums one (uid, int16 samples) per speaker into a single frame: int32 accumulation, Q8 per-user gain, clipped."""
+        # Resampled frames can be a sample or two off the nominal size, so mix to the longest one
+        mix = np.zeros(max(len(samples) for _, samples in frames), dtype=np.int32)
+        active = False
+        for uid, samples in frames:
+            gain = self.user_volumes.get(uid, 1.0)
+            if uid in self.muted_users or gain <= 0: continue
+            samples = samples.astype(np.int32)
+            if gain != 1.0: samples = (samples * int(gain * 256)) >> 8
+            mix[:len(samples)] += samples
+            active = True
+        if not active: return None
+        return np.clip(mix, -32768, 32767).astype(np.int16)
 
     def extract_video_frame(self, path):
         try:
@@ -66,22 +460,3 @@ class MediaManager:
                 return Image.fromarray(frame)
         except: pass
         return None
-
-    def capture_screen_jpeg(self, max_width=1280, region=None, monitor_idx=1):
-        try:
-            with mss.mss() as sct:
-                if region: sct_img = sct.grab(region)
-                else:
-                    if monitor_idx >= len(sct.monitors): monitor_idx = 1
-                    sct_img = sct.grab(sct.monitors[monitor_idx])
-            img = np.array(sct_img)
-            height, width = img.shape[:2]
-            if width > max_width:
-                scale = max_width / width
-                img = cv2.resize(img, (int(width * scale), int(height * scale)))
-            img_bgr = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
-            encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 40] 
-            result, encimg = cv2.imencode('.jpg', img_bgr, encode_param)
-            if result: return encimg.tobytes()
-        except Exception: pass
-        return None
\ No newline at end of file
@@ -0,0 +1,48 @@
+import json
+import zlib
+
+def make_record(uid, nick, is_live, avatar, bio, is_host):
+    return [uid, nick, 1 if is_live else 0, avatar, bio, 1 if is_host else 0]
+
+class Membership:
+    """Versioned room roster. Records are [uid, nick, live, avatar_hash, bio, is_host].
+    The host bumps the version on every change and sends it as a delta; clients apply
+    deltas strictly in order and fall back to a full snapshot on a gap or checksum mismatch."""
+    def __init__(self):
+        self.version = 0
+        self.records = {}
+
+    def upsert(self, record):
+        self.records[record[0]] = record
+        self.version += 1
+        return self.version
+
+    def remove(self, uid):
+        self.records.pop(uid, None)
+        self.version += 1
+        return self.version
+
+    def checksum(self):
+        canonical = json.dumps(sorted(self.records.values()), separators=(",", ":"))
+        return zlib.crc32(canonical.encode())
+
+    def delta(self, version, body):
+        return json.dumps([version, body], separators=(",", ":")).encode()
+
+    def snapshot(self):
+        return json.dumps([self.version, list(self.records.values())], separators=(",", ":")).encode()
+
+    def load_snapshot(self, payload):
+        version, records = json.loads(payload)
+        self.version = version
+        self.records = {r[0]: r for r in records}
+
+    def apply(self, payload, removal=False):
+        """Applies a host delta. Returns False when a version gap means a resync is needed."""
+        version, body = json.loads(payload)
+        if version <= self.version: return True # Duplicate or already covered by a snapshot
+        if version != self.version + 1: return False
+        if removal: self.records.pop(body, None)
+        else: self.records[body[0]] = body
+        self.version = version
+        return True
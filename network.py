@@ -1,13 +1,28 @@
 import socket
+import struct
 import threading
-import queue
 import time
 import os
+import protocol
+import transfer
+import membership
+import avatars
+import jitter
+import fec
+import reassembly
+import control
 from config import ConfigManager
 from chat_logger import ChatLogger
 
 UDP_MAX_SIZE = 60000
+VIDEO_CHUNK_SIZE = 1200 # Video chunks stay under a VPN MTU, so one lost IP fragment can't take out a 60 KB datagram
+DOWNLOAD_DIR = "hub_downloads"
 HEARTBEAT_INTERVAL = 2.0
+REPORT_INTERVAL = 1.0 # Viewer -> streamer reception reports that drive the streamer's bitrate
+REPORT_TTL = 3.0
+HISTORY_PAGE = 50
+HISTORY_CATCHUP = 500 # Most messages a rejoining client is caught up on in one go
+HISTORY_PAGE_BYTES = 48000
 TIMEOUT_LIMIT = 12.0
 
 class NetworkNode:
@@ -29,7 +44,11 @@ class NetworkNode:
         self.room_password = ""
         
         self.connected_peers = {} 
-        self.dp_cache = {} 
+        self.peer_avatars = {} # uid -> avatar hash
+        self.avatar_store = avatars.AvatarStore()
+        self.avatar_requests = {} # avatar hash -> last AVATAR_REQ time
+        self.members = membership.Membership()
+        self.member_sync_at = 0.0
         self.banned_uids = set() 
         self.file_size_limit_mb = 10 
         
@@ -37,16 +56,75 @@ class NetworkNode:
         self.host_timeout_counter = 0 
         
         self.current_target = None
-        self.audio_queue = queue.Queue()
-        self.video_buffer = {} 
+        self.watching_uid = None
+        self.stream_viewers = {} # Host only: streamer uid -> set of subscribed viewer uids
+        self.stream_viewer_count = 0 # Viewers of my own stream, as reported by the host
+        self.jitter_buffers = {} # sender uid -> JitterBuffer of received voice frames
+        self.voice_codec = config.get("voice_codec", "adpcm") # Replaced by the host's choice on ACCEPT
+        self.voice_rate = int(config.get("voice_rate", 16000))
+        self.video_frames = reassembly.FrameReassembler()
+        self.video_seen = False # A chunk arrived since watching began; before that, silence is not an outage
+        self.video_reports = {} # viewer uid -> (received at, REPORT_HEADER fields) for my own stream
+        self.video_fec = float(config.get("video_fec", 0.2)) # Parity chunks per data chunk sent with each frame
+        self.video_epoch = os.urandom(1)[0] # Bumped per stream, so viewers can tell a restart from late frames
         self.chat_logger = None
-
-    def load_my_dp_b64(self):
-        # FIXED: Just strictly return the Base64 cache from the JSON to avoid File errors!
-        dp = self.config.get("dp_dataurl", "")
-        if dp.startswith("data:image"):
-            return dp.split(",", 1)[1] 
-        return dp
+        self.history_last = 0 # Newest host log id seen; sent on (re)join so only newer messages come back
+        self.history_oldest = None # Oldest log id shown, the cursor for scrolling further up
+        self.tx_seq = {}
+        self.control = control.ControlChannel(lambda payload: self.packet(protocol.BUNDLE, payload), self.send_datagram)
+
+        self.file_senders = {} # (xfer_id, dest uid or None for the host) -> FileSender
+        self.file_receivers = {} # (origin uid, xfer_id) -> FileReceiver
+        self.partial_receivers = {} # digest -> FileReceiver still being written, shared by every offer of that blob
+        self.pending_relays = {} # Host only: peer uid -> transfers to resume when it rejoins
+        self.file_cache = transfer.ContentCache(max_bytes=int(config.get("file_cache_mb", 4096)) * 1024 * 1024)
+        self.transfer_cond = threading.Condition()
+        self.transfer_wakes = 0 # Bumped by wake_senders, so a wake between pump and wait isn't lost
+        self.progress_times = {}
+
+        self.handlers = {
+            protocol.BEAT: self.handle_beat,
+            protocol.JOIN: self.handle_join,
+            protocol.LEAVE: self.handle_leave,
+            protocol.LIMIT: self.handle_limit,
+            protocol.REQ_SEC: self.handle_req_sec,
+            protocol.SEC_ACCEPT: self.handle_sec_accept,
+            protocol.NEW_SEC_HOST: self.handle_new_sec_host,
+            protocol.MIGRATE: self.handle_migrate,
+            protocol.HISTORY: self.handle_history,
+            protocol.HISTORY_REQ: self.handle_history_req,
+            protocol.PROFILE: self.handle_profile,
+            protocol.ACCEPT: self.handle_accept,
+            protocol.REJECT: self.handle_reject,
+            protocol.STREAM_START: self.handle_stream_start,
+            protocol.STREAM_STOP: self.handle_stream_stop,
+            protocol.LIST: self.handle_list,
+            protocol.TEXT: self.handle_text,
+            protocol.FILE: self.handle_file,
+            protocol.FILE_OFFER: self.handle_file_offer,
+            protocol.FILE_ACK: self.handle_file_ack,
+            protocol.AUDIO: self.handle_audio,
+            protocol.VIDEO: self.handle_video,
+            protocol.WATCH: self.handle_watch,
+            protocol.UNWATCH: self.handle_unwatch,
+            protocol.VIEWERS: self.handle_viewers,
+            protocol.VIDEO_REPORT: self.handle_video_report,
+            protocol.MEMBER_JOIN: self.handle_member_delta,
+            protocol.MEMBER_UPDATE: self.handle_member_delta,
+            protocol.MEMBER_LEAVE: self.handle_member_leave,
+            protocol.MEMBER_SUM: self.handle_member_sum,
+            protocol.MEMBER_SYNC: self.handle_member_sync,
+            protocol.AVATAR_REQ: self.handle_avatar_req,
+            protocol.AVATAR: self.handle_avatar,
+            protocol.BUNDLE: self.handle_bundle,
+        }
+
+    def my_avatar(self):
+        avatar = self.config.get("avatar", "")
+        return avatar if self.avatar_store.has(avatar) else ""
+
+    def dp_b64(self, uid):
+        return self.avatar_store.b64(self.peer_avatars.get(uid, ""))
         
     def start_host(self, port, room_name, password):
         self.is_host = True
@@ -61,7 +139,8 @@ class NetworkNode:
         
         self.running = True
         self.connected_peers[self.uid] = {"addr": ('127.0.0.1', port), "nick": self.nickname, "last_seen": time.time(), "is_live": False, "bio": self.bio, "is_host": True}
-        self.dp_cache[self.uid] = self.load_my_dp_b64()
+        self.peer_avatars[self.uid] = self.my_avatar()
+        self.publish_member(self.uid)
         
         self.start_threads()
         
@@ -72,23 +151,50 @@ class NetworkNode:
         self.host_port = port
         self.running = True
         self.start_threads()
-        
-        dp_b64 = self.load_my_dp_b64()
-        self.send_packet(f"JOIN|{self.uid}|{self.nickname}|{self.room_password}|{dp_b64}|{self.bio}".encode())
+        self.send_join()
+
+    def send_join(self):
+        codecs = [self.config.get("voice_codec", "adpcm")] + list(protocol.VOICE_CODECS)
+        codecs = ",".join(dict.fromkeys(c for c in codecs if c in protocol.VOICE_CODECS))
+        self.send_packet(self.packet(protocol.JOIN, protocol.fields(self.nickname, self.room_password, self.my_avatar(), codecs, self.history_last, self.bio)))
+
+    def pick_voice_codec(self, offered):
+        # Mine first if the joiner has it, then the first shared one; PCM always works
+        offered = offered.split(",")
+        if self.voice_codec in offered: return self.voice_codec
+        return next((c for c in protocol.VOICE_CODECS if c in offered), "pcm")
 
     def start_threads(self):
         threading.Thread(target=self.network_listener, daemon=True).start()
         threading.Thread(target=self.heartbeat_monitor, daemon=True).start()
+        threading.Thread(target=self.report_monitor, daemon=True).start()
+        threading.Thread(target=self.control_flusher, daemon=True).start()
+
+    def packet(self, p_type, payload=b"", sender=None):
+        seq = self.tx_seq.get(p_type, 0)
+        self.tx_seq[p_type] = seq + 1
+        if isinstance(payload, str): payload = payload.encode()
+        return protocol.pack(p_type, sender or self.uid, seq, payload)
 
     def send_packet(self, data, target=None):
-        try:
-            if target: self.sock.sendto(data, target)
-            elif not self.is_host and self.current_target: self.sock.sendto(data, self.current_target)
+        if not target:
+            if self.is_host or not self.current_target: return
+            target = self.current_target
+        if data[1] in protocol.CONTROL_TYPES: self.control.queue(target, data)
+        else: self.send_datagram(data, target)
+
+    def send_datagram(self, data, target):
+        try: self.sock.sendto(data, target)
         except: pass
 
+    def control_flusher(self):
+        while self.running:
+            self.control.wait()
+            self.control.flush()
+
     def broadcast(self, data, exclude_uid=None):
         if not self.is_host: return
-        for uid, peer in self.connected_peers.items():
+        for uid, peer in list(self.connected_peers.items()): # The listener may add or drop peers meanwhile
             if uid != exclude_uid and uid != self.uid:
                 self.send_packet(data, peer["addr"])
 
@@ -97,11 +203,24 @@ class NetworkNode:
         addr = self.connected_peers[uid_to_ban]["addr"]
         nick = self.connected_peers[uid_to_ban]["nick"]
         self.banned_uids.add(uid_to_ban)
-        del self.connected_peers[uid_to_ban]
-        self.send_packet(b"REJECT|Host|You have been BANNED by the Admin.", addr)
-        self.update_user_list()
+        self.remove_peer(uid_to_ban)
+        self.send_packet(self.packet(protocol.REJECT, "You have been BANNED by the Admin.", sender="Host"), addr)
         self.app.on_chat_received("SYSTEM", "System", f"🛡️ Admin banned {nick}.")
 
+    def remove_peer(self, uid):
+        """Returns False if uid was already gone (a LEAVE racing the heartbeat's timeout)."""
+        if self.connected_peers.pop(uid, None) is None: return False
+        self.stream_viewers.pop(uid, None)
+        for streamer_uid, viewers in list(self.stream_viewers.items()):
+            if uid in viewers:
+                viewers.discard(uid)
+                self.notify_viewer_count(streamer_uid)
+        if uid in self.members.records:
+            version = self.members.remove(uid)
+            self.broadcast(self.packet(protocol.MEMBER_LEAVE, self.members.delta(version, uid), sender="Host"))
+            self.update_user_list()
+        return True
+
     def unban_user(self, uid_to_unban):
         if not self.is_host or uid_to_unban not in self.banned_uids: return
         self.banned_uids.remove(uid_to_unban)
@@ -110,46 +229,56 @@ class NetworkNode:
     def heartbeat_monitor(self):
         while self.running:
             time.sleep(HEARTBEAT_INTERVAL)
-            if self.is_host:
-                current_time = time.time()
-                dead_uids = []
-                for uid, peer in self.connected_peers.items():
-                    if uid != self.uid and (current_time - peer["last_seen"] > TIMEOUT_LIMIT):
-                        dead_uids.append(uid)
-                for uid in dead_uids:
-                    nick = self.connected_peers[uid]["nick"]
-                    del self.connected_peers[uid]
-                    self.update_user_list()
-                    self.app.on_chat_received("SYSTEM", "System", f"{nick} timed out and left.")
-            else:
-                self.send_packet(f"BEAT|{self.uid}".encode())
-                
-                self.host_timeout_counter += HEARTBEAT_INTERVAL
-                if self.host_timeout_counter > TIMEOUT_LIMIT + 2.0: 
-                    if self.sec_host_uid and self.sec_host_uid == self.uid:
-                        self.app.on_chat_received("SYSTEM", "System", "⚠️ Host timed out! You are taking over as Host.")
-                        self.is_host = True
-                        self.host_timeout_counter = 0
-                        self.app.after(0, self.app.rebuild_controls_as_host)
-                    elif self.sec_host_uid:
-                        self.app.on_chat_received("SYSTEM", "System", "⚠️ Host timed out! Migrating to Secondary Host...")
-                        if self.sec_host_uid in self.connected_peers:
-                            self.current_target = self.connected_peers[self.sec_host_uid]["addr"]
-                        self.host_timeout_counter = 0
-                        dp = self.load_my_dp_b64()
-                        self.send_packet(f"JOIN|{self.uid}|{self.nickname}|{self.room_password}|{dp}|{self.bio}".encode())
+            self.heartbeat_tick()
+
+    def report_monitor(self):
+        while self.running:
+            time.sleep(REPORT_INTERVAL)
+            self.report_video()
+
+    def heartbeat_tick(self):
+        self.expire_transfers()
+        if self.is_host:
+            current_time = time.time()
+            # Work from snapshots; the listener thread joins and drops peers while this runs
+            dead_peers = [(uid, peer) for uid, peer in list(self.connected_peers.items())
+                          if uid != self.uid and (current_time - peer["last_seen"] > TIMEOUT_LIMIT)]
+            for uid, peer in dead_peers:
+                if self.remove_peer(uid): self.app.on_chat_received("SYSTEM", "System", f"{peer['nick']} timed out and left.")
+            peers = list(self.connected_peers.items())
+            # Re-announce viewer counts so a lost VIEWERS packet can't stall a streamer
+            for uid, peer in peers:
+                if peer["is_live"] and uid != self.uid: self.notify_viewer_count(uid)
+            for uid, peer in peers:
+                if uid != self.uid: self.want_avatar(self.peer_avatars.get(uid, ""), peer["addr"])
+            # Compact roster summary lets clients detect a lost delta and resync
+            self.broadcast(self.packet(protocol.MEMBER_SUM, protocol.SUM_HEADER.pack(self.members.version, self.members.checksum()), sender="Host"))
+        else:
+            self.send_packet(self.packet(protocol.BEAT))
+            
+            self.host_timeout_counter += HEARTBEAT_INTERVAL
+            if self.host_timeout_counter > TIMEOUT_LIMIT + 2.0: 
+                if self.sec_host_uid and self.sec_host_uid == self.uid:
+                    self.app.on_chat_received("SYSTEM", "System", "⚠️ Host timed out! You are taking over as Host.")
+                    self.become_host()
+                    self.app.after(0, self.app.rebuild_controls_as_host)
+                elif self.sec_host_uid:
+                    self.app.on_chat_received("SYSTEM", "System", "⚠️ Host timed out! Migrating to Secondary Host...")
+                    if self.sec_host_uid in self.connected_peers:
+                        self.current_target = self.connected_peers[self.sec_host_uid]["addr"]
+                    self.host_timeout_counter = 0
+                    self.send_join()
 
     def send_profile_update(self):
         self.nickname = self.config["nickname"]
         self.bio = self.config.get("bio", "")
-        dp_b64 = self.load_my_dp_b64()
-        data = f"PROFILE|{self.uid}|{self.nickname}|{dp_b64}|{self.bio}".encode()
+        avatar = self.my_avatar()
+        data = self.packet(protocol.PROFILE, protocol.fields(self.nickname, avatar, self.bio))
         if self.is_host:
             self.connected_peers[self.uid]["nick"] = self.nickname
             self.connected_peers[self.uid]["bio"] = self.bio
-            self.dp_cache[self.uid] = dp_b64
-            self.broadcast(data)
-            self.update_user_list()
+            self.peer_avatars[self.uid] = avatar
+            self.publish_member(self.uid)
             self.app.update_all_chat_dps()
         else:
             self.send_packet(data)
@@ -158,191 +287,414 @@ class NetworkNode:
         while self.running:
             try:
                 data, addr = self.sock.recvfrom(65535)
-                parts = data.split(b'|', maxsplit=2)
-                if len(parts) < 2: continue
-                
-                p_type = parts[0].decode(errors='ignore')
-                sender_uid = parts[1].decode(errors='ignore')
-                payload = parts[2] if len(parts) > 2 else b''
+            except OSError:
+                break
+            self.handle_datagram(data, addr)
 
-                if not self.is_host and addr == self.current_target:
-                    self.host_timeout_counter = 0
+    def handle_datagram(self, data, addr):
+        packet = protocol.unpack(data)
+        if not packet: return
+        p_type, sender_uid, seq, payload = packet
 
-                if self.is_host and sender_uid in self.connected_peers:
-                    self.connected_peers[sender_uid]["last_seen"] = time.time()
-                    self.connected_peers[sender_uid]["addr"] = addr 
-
-                if p_type == "BEAT": continue 
-
-                elif p_type == "JOIN":
-                    if self.is_host:
-                        if sender_uid in self.banned_uids:
-                            self.send_packet(f"REJECT|Host|You are BANNED from this room.".encode(), addr)
-                            continue
-                            
-                        join_parts = payload.split(b'|', maxsplit=4)
-                        if len(join_parts) < 1: continue
-                        nick = join_parts[0].decode(errors='ignore')
-                        pwd = join_parts[1].decode(errors='ignore') if len(join_parts) > 1 else ""
-                        dp_b64 = join_parts[2].decode(errors='ignore') if len(join_parts) > 2 else ""
-                        bio = join_parts[3].decode(errors='ignore') if len(join_parts) > 3 else ""
-                        
-                        if self.room_password and pwd != self.room_password:
-                            self.send_packet(f"REJECT|Host|Invalid Password.".encode(), addr)
-                            continue
-                        
-                        is_new = sender_uid not in self.connected_peers
-                        self.connected_peers[sender_uid] = {"addr": addr, "nick": nick, "last_seen": time.time(), "is_live": False, "bio": bio, "is_host": False}
-                        self.dp_cache[sender_uid] = dp_b64
-                        
-                        self.send_packet(f"ACCEPT|Host|{self.room_code}|{self.room_name}|{self.file_size_limit_mb}".encode(), addr)
-                        if self.chat_logger:
-                            for msg in self.chat_logger.history:
-                                hist_pkt = f"HISTORY|{msg['uid']}|{msg['nick']}|{msg['msg']}".encode()
-                                self.send_packet(hist_pkt, addr)
-                            
-                        self.update_user_list() 
-                        if is_new: self.app.on_chat_received("SYSTEM", "System", f"{nick} joined.")
-
-                elif p_type == "LEAVE":
-                    if self.is_host and sender_uid in self.connected_peers:
-                        nick = self.connected_peers[sender_uid]["nick"]
-                        del self.connected_peers[sender_uid]
-                        self.update_user_list()
-                        self.app.on_chat_received("SYSTEM", "System", f"{nick} left the room.")
-                    elif not self.is_host:
-                        self.app.on_chat_received("SYSTEM", "System", "Host closed the room.")
-                        self.app.after(1500, self.app.disconnect)
-                        
-                elif p_type == "LIMIT":
-                    if not self.is_host:
-                        self.file_size_limit_mb = int(sender_uid)
-                        self.app.on_chat_received("SYSTEM", "System", f"Host changed file limit to {self.file_size_limit_mb}MB.")
-
-                elif p_type == "REQ_SEC":
-                    if not self.is_host:
-                        self.app.show_secondary_host_prompt()
-                        
-                elif p_type == "SEC_ACCEPT":
-                    if self.is_host:
-                        self.sec_host_uid = sender_uid
-                        self.broadcast(b"NEW_SEC_HOST|" + sender_uid.encode())
-                        nick = self.connected_peers.get(sender_uid, {}).get("nick", "Someone")
-                        self.app.on_chat_received("SYSTEM", "System", f"🛡️ {nick} is now the Secondary Host.")
-
-                elif p_type == "NEW_SEC_HOST":
-                    if not self.is_host:
-                        self.sec_host_uid = payload.decode(errors='ignore')
-
-                elif p_type == "MIGRATE":
-                    mig_uid = payload.decode(errors='ignore')
-                    if not self.is_host:
-                        if self.uid == mig_uid:
-                            self.is_host = True
-                            self.app.on_chat_received("SYSTEM", "System", "👑 You have been promoted to Host! Room migrated.")
-                            self.app.rebuild_controls_as_host()
-                        else:
-                            if mig_uid in self.connected_peers:
-                                self.current_target = self.connected_peers[mig_uid]["addr"]
-                                self.app.on_chat_received("SYSTEM", "System", "Host left. Migrating to Secondary Host...")
-                                dp_b64 = self.load_my_dp_b64()
-                                self.send_packet(f"JOIN|{self.uid}|{self.nickname}|{self.room_password}|{dp_b64}|{self.bio}".encode())
-
-                elif p_type == "HISTORY":
-                    hist_parts = payload.split(b'|', maxsplit=1)
-                    if len(hist_parts) == 2:
-                        h_nick = hist_parts[0].decode(errors='ignore')
-                        h_msg = hist_parts[1].decode(errors='ignore')
-                        self.app.on_chat_received(sender_uid, h_nick, h_msg)
-
-                elif p_type == "PROFILE":
-                    profile_parts = payload.split(b'|', maxsplit=2)
-                    if len(profile_parts) >= 2:
-                        nick = profile_parts[0].decode(errors='ignore')
-                        dp_b64 = profile_parts[1].decode(errors='ignore')
-                        bio = profile_parts[2].decode(errors='ignore') if len(profile_parts) > 2 else ""
-                        if self.is_host:
-                            if sender_uid in self.connected_peers:
-                                self.connected_peers[sender_uid]["nick"] = nick
-                                self.connected_peers[sender_uid]["bio"] = bio
-                                self.dp_cache[sender_uid] = dp_b64
-                                self.broadcast(data, exclude_uid=sender_uid)
-                                self.update_user_list()
-                        else:
-                            self.dp_cache[sender_uid] = dp_b64
-                            if sender_uid in self.connected_peers: self.connected_peers[sender_uid]["bio"] = bio
-                        self.app.update_all_chat_dps()
-
-                elif p_type == "ACCEPT":
-                    acc_parts = payload.split(b'|', maxsplit=2)
-                    if len(acc_parts) >= 2:
-                        room_code = acc_parts[0].decode(errors='ignore')
-                        room_name = acc_parts[1].decode(errors='ignore')
-                        if len(acc_parts) == 3:
-                            self.file_size_limit_mb = int(acc_parts[2].decode())
-                        self.app.on_room_accepted(room_code, room_name)
-
-                elif p_type == "REJECT":
-                    reason = payload.decode(errors='ignore')
-                    self.app.on_chat_received("SYSTEM", "System", f"Connection rejected: {reason}")
-
-                elif p_type == "STREAM_START" or p_type == "STREAM_STOP":
-                    if self.is_host and sender_uid in self.connected_peers:
-                        self.connected_peers[sender_uid]["is_live"] = (p_type == "STREAM_START")
-                        self.update_user_list()
-
-                elif p_type == "LIST":
-                    users_data = payload.decode(errors='ignore').split(',')
-                    parsed_users = []
-                    for u in users_data:
-                        if not u: continue
-                        u_parts = u.split(':', 4)
-                        if len(u_parts) >= 4:
-                            self.dp_cache[u_parts[0]] = u_parts[3]
-                            if len(u_parts) == 5 and u_parts[0] in self.connected_peers:
-                                self.connected_peers[u_parts[0]]["bio"] = u_parts[4]
-                            parsed_users.append(u_parts)
-                    self.app.update_user_list_ui(parsed_users)
-                    self.app.update_all_chat_dps()
-
-                elif p_type == "T":
-                    t_parts = payload.split(b'|', maxsplit=1)
-                    if len(t_parts) == 2:
-                        nick = t_parts[0].decode(errors='ignore')
-                        msg = t_parts[1].decode(errors='ignore')
-                        if self.is_host: 
-                            if self.chat_logger: self.chat_logger.add_message(sender_uid, nick, msg)
-                            self.broadcast(data, exclude_uid=sender_uid)
-                        self.app.on_chat_received(sender_uid, nick, msg)
-
-                elif p_type == "FILE":
-                    if self.is_host: self.broadcast(data, exclude_uid=sender_uid)
-                    f_parts = payload.split(b'|', maxsplit=2)
-                    if len(f_parts) == 3:
-                        filename = f_parts[0].decode(errors='ignore')
-                        chunk_id = int(f_parts[1])
-                        f_data = f_parts[2]
-                        self.handle_file_chunk(sender_uid, filename, chunk_id, f_data)
-
-                elif p_type == "A":
-                    if self.is_host: self.broadcast(data, exclude_uid=sender_uid)
-                    self.audio_queue.put((payload, sender_uid))
-                    self.app.set_user_speaking(sender_uid)
-
-                elif p_type == "V":
-                    if self.is_host: self.broadcast(data, exclude_uid=sender_uid)
-                    if watching_uid == sender_uid:
-                        self.handle_video_chunk(payload)
+        if not self.is_host and addr == self.current_target:
+            self.host_timeout_counter = 0
+
+        if self.is_host and sender_uid in self.connected_peers:
+            self.connected_peers[sender_uid]["last_seen"] = time.time()
+            self.connected_peers[sender_uid]["addr"] = addr
+
+        handler = self.handlers.get(p_type)
+        if handler is None: return
+        # A malformed payload from anyone must not take the receive thread down with it
+        try: handler(sender_uid, seq, payload, addr, data)
+        except (ValueError, IndexError, KeyError, struct.error): pass
+
+    def handle_beat(self, sender_uid, seq, payload, addr, data):
+        pass
+
+    def handle_bundle(self, sender_uid, seq, payload, addr, data):
+        for inner in self.control.receive(addr, payload): self.handle_datagram(inner, addr)
+
+    def handle_join(self, sender_uid, seq, payload, addr, data):
+        if not self.is_host: return
+        if sender_uid in self.banned_uids:
+            self.send_packet(self.packet(protocol.REJECT, "You are BANNED from this room.", sender="Host"), addr)
+            return
+
+        # bio goes last so any pipes in it survive the split
+        nick, pwd, avatar, codecs, last_seen, bio = (protocol.split_fields(payload, 6) + ["", "", "", "", ""])[:6]
+
+        if self.room_password and pwd != self.room_password:
+            self.send_packet(self.packet(protocol.REJECT, "Invalid Password.", sender="Host"), addr)
+            return
+
+        is_new = sender_uid not in self.connected_peers
+        self.connected_peers[sender_uid] = {"addr": addr, "nick": nick, "last_seen": time.time(), "is_live": False, "bio": bio, "is_host": False}
+        self.peer_avatars[sender_uid] = avatar
+        self.want_avatar(avatar, addr)
+
+        accept = protocol.fields(self.room_code, self.room_name, self.file_size_limit_mb, self.pick_voice_codec(codecs), self.voice_rate)
+        self.send_packet(self.packet(protocol.ACCEPT, accept, sender="Host"), addr)
+        if self.chat_logger: self.send_history_since(addr, int(last_seen) if last_seen.isdigit() else 0)
+
+        # Everyone else gets a one-record delta; only the joiner gets the full roster
+        self.publish_member(sender_uid, exclude_uid=sender_uid)
+        self.send_packet(self.packet(protocol.LIST, self.members.snapshot(), sender="Host"), addr)
+        if is_new: self.app.on_chat_received("SYSTEM", "System", f"{nick} joined.")
+        self.resume_relays(sender_uid)
+
+    def handle_leave(self, sender_uid, seq, payload, addr, data):
+        if self.is_host and sender_uid in self.connected_peers:
+            nick = self.connected_peers[sender_uid]["nick"]
+            self.remove_peer(sender_uid)
+            self.app.on_chat_received("SYSTEM", "System", f"{nick} left the room.")
+        elif not self.is_host:
+            self.app.on_chat_received("SYSTEM", "System", "Host closed the room.")
+            self.app.after(1500, self.app.disconnect)
+
+    def handle_limit(self, sender_uid, seq, payload, addr, data):
+        if not self.is_host:
+            self.file_size_limit_mb = int(payload)
+            self.app.on_chat_received("SYSTEM", "System", f"Host changed file limit to {self.file_size_limit_mb}MB.")
+
+    def handle_req_sec(self, sender_uid, seq, payload, addr, data):
+        if not self.is_host:
+            self.app.show_secondary_host_prompt()
+
+    def handle_sec_accept(self, sender_uid, seq, payload, addr, data):
+        if self.is_host:
+            self.sec_host_uid = sender_uid
+            self.broadcast(self.packet(protocol.NEW_SEC_HOST, sender_uid.encode()))
+            nick = self.connected_peers.get(sender_uid, {}).get("nick", "Someone")
+            self.app.on_chat_received("SYSTEM", "System", f"🛡️ {nick} is now the Secondary Host.")
+
+    def handle_new_sec_host(self, sender_uid, seq, payload, addr, data):
+        if not self.is_host:
+            self.sec_host_uid = payload.decode(errors='ignore')
+
+    def handle_migrate(self, sender_uid, seq, payload, addr, data):
+        mig_uid = payload.decode(errors='ignore')
+        if self.is_host: return
+        if self.uid == mig_uid:
+            self.become_host()
+            self.app.on_chat_received("SYSTEM", "System", "👑 You have been promoted to Host! Room migrated.")
+            self.app.rebuild_controls_as_host()
+        elif mig_uid in self.connected_peers:
+            self.current_target = self.connected_peers[mig_uid]["addr"]
+            self.app.on_chat_received("SYSTEM", "System", "Host left. Migrating to Secondary Host...")
+            self.send_join()
+
+    def send_history_since(self, addr, last_seen):
+        # A fresh joiner gets the newest page and scrolls up for more; a rejoin gets just what it missed
+        if last_seen: self.send_history(addr, self.chat_logger.after(last_seen, HISTORY_CATCHUP))
+        else:
+            rows = self.chat_logger.latest(HISTORY_PAGE)
+            self.send_history(addr, rows, protocol.HISTORY_MORE if rows and rows[0]["id"] > 1 else 0)
+
+    def send_history(self, addr, rows, flags=0):
+        """Sends rows as HISTORY pages of one datagram each. Pages go out in the order the client stacks
+        them: oldest first when appending, newest first when they go above what it already shows."""
+        pages, page, size = [], [], 0
+        for row in rows:
+            row_size = len(row["msg"].encode()) + len(row["nick"].encode()) + len(row["uid"]) + 48
+            if page and size + row_size > HISTORY_PAGE_BYTES:
+                pages.append(page)
+                page, size = [], 0
+            page.append(row)
+            size += row_size
+        if page or flags & protocol.HISTORY_OLDER: pages.append(page) # An empty older page still ends the client's wait
+        if flags & protocol.HISTORY_OLDER: pages.reverse()
+        for i, page in enumerate(pages):
+            # Only the final page says whether there is more, so an earlier one can't end scroll-back
+            page_flags = flags | protocol.HISTORY_LAST if i == len(pages) - 1 else flags & ~protocol.HISTORY_MORE
+            self.send_packet(self.packet(protocol.HISTORY, protocol.pack_history(page, page_flags), sender="Host"), addr)
+
+    def handle_history(self, sender_uid, seq, payload, addr, data):
+        try: flags, rows = protocol.unpack_history(payload)
+        except Exception: return
+        if rows:
+            self.history_last = max(self.history_last, rows[-1]["id"])
+            if self.history_oldest is None or rows[0]["id"] < self.history_oldest: self.history_oldest = rows[0]["id"]
+        elif not flags & protocol.HISTORY_LAST: return
+        self.app.on_history_page(rows, bool(flags & protocol.HISTORY_MORE), bool(flags & protocol.HISTORY_OLDER), bool(flags & protocol.HISTORY_LAST))
+
+    def handle_history_req(self, sender_uid, seq, payload, addr, data):
+        if not self.is_host or not self.chat_logger or len(payload) < protocol.HISTORY_REQ_HEADER.size: return
+        if sender_uid not in self.connected_peers: return # Only admitted members may page through the log
+        before, = protocol.HISTORY_REQ_HEADER.unpack_from(payload)
+        rows = self.chat_logger.before(before, HISTORY_PAGE)
+        more = protocol.HISTORY_MORE if rows and rows[0]["id"] > 1 else 0
+        self.send_history(addr, rows, protocol.HISTORY_OLDER | more)
+
+    def show_history(self):
+        """Host side: puts the newest page of its own log on screen."""
+        if not self.chat_logger: return
+        rows = self.chat_logger.latest(HISTORY_PAGE)
+        self.history_oldest = rows[0]["id"] if rows else None
+        self.app.on_history_page(rows, bool(rows) and rows[0]["id"] > 1, False)
+
+    def load_older_history(self):
+        if not self.history_oldest or self.history_oldest <= 1: return
+        if not self.is_host:
+            self.send_packet(self.packet(protocol.HISTORY_REQ, protocol.HISTORY_REQ_HEADER.pack(self.history_oldest)))
+        elif self.chat_logger:
+            rows = self.chat_logger.before(self.history_oldest, HISTORY_PAGE)
+            if rows: self.history_oldest = rows[0]["id"]
+            self.app.on_history_page(rows, bool(rows) and rows[0]["id"] > 1, True)
+
+    def handle_profile(self, sender_uid, seq, payload, addr, data):
+        profile_parts = protocol.split_fields(payload, 3)
+        if len(profile_parts) < 2: return
+        nick, avatar = profile_parts[0], profile_parts[1]
+        bio = profile_parts[2] if len(profile_parts) > 2 else ""
+        if not self.is_host or sender_uid not in self.connected_peers: return
+        self.connected_peers[sender_uid]["nick"] = nick
+        self.connected_peers[sender_uid]["bio"] = bio
+        self.peer_avatars[sender_uid] = avatar
+        self.want_avatar(avatar, addr)
+        self.publish_member(sender_uid)
+        self.app.update_all_chat_dps()
+
+    def handle_accept(self, sender_uid, seq, payload, addr, data):
+        acc_parts = protocol.split_fields(payload, 5)
+        if len(acc_parts) < 2: return
+        if len(acc_parts) >= 3:
+            self.file_size_limit_mb = int(acc_parts[2])
+        if len(acc_parts) == 5:
+            self.voice_codec, self.voice_rate = acc_parts[3], int(acc_parts[4] or 0)
+        self.app.on_room_accepted(acc_parts[0], acc_parts[1])
+        # A (re)joined host starts with empty viewer sets, so re-subscribe
+        if self.watching_uid and self.watching_uid != self.uid:
+            self.send_packet(self.packet(protocol.WATCH, self.watching_uid))
+
+    def handle_reject(self, sender_uid, seq, payload, addr, data):
+        reason = payload.decode(errors='ignore')
+        self.app.on_chat_received("SYSTEM", "System", f"Connection rejected: {reason}")
+
+    def handle_stream_start(self, sender_uid, seq, payload, addr, data):
+        self.set_peer_live(sender_uid, True)
+
+    def handle_stream_stop(self, sender_uid, seq, payload, addr, data):
+        self.set_peer_live(sender_uid, False)
+
+    def set_peer_live(self, uid, is_live):
+        if self.is_host and uid in self.connected_peers:
+            self.connected_peers[uid]["is_live"] = is_live
+            self.publish_member(uid)
+
+    def set_streaming(self, is_live):
+        if is_live: self.video_epoch = (self.video_epoch + 1) & 0xFF
+        if self.is_host: self.set_peer_live(self.uid, is_live)
+        else: self.send_packet(self.packet(protocol.STREAM_START if is_live else protocol.STREAM_STOP))
+
+    def become_host(self):
+        self.is_host = True
+        self.host_timeout_counter = 0
+        self.connected_peers[self.uid] = {"addr": ('127.0.0.1', self.sock.getsockname()[1]), "nick": self.nickname, "last_seen": time.time(), "is_live": False, "bio": self.bio, "is_host": True}
+        self.peer_avatars[self.uid] = self.my_avatar()
+        # Peers rejoin and get a fresh snapshot; keep counting up so stale deltas stay ignorable
+        self.members.records.clear()
+        self.publish_member(self.uid)
+
+    def publish_member(self, uid, exclude_uid=None):
+        peer = self.connected_peers[uid]
+        record = membership.make_record(uid, peer["nick"], peer["is_live"], self.peer_avatars.get(uid, ""), peer.get("bio", ""), peer.get("is_host", False))
+        p_type = protocol.MEMBER_UPDATE if uid in self.members.records else protocol.MEMBER_JOIN
+        version = self.members.upsert(record)
+        self.broadcast(self.packet(p_type, self.members.delta(version, record), sender="Host"), exclude_uid=exclude_uid)
+        self.update_user_list()
+
+    def request_member_sync(self):
+        now = time.time()
+        if now - self.member_sync_at < HEARTBEAT_INTERVAL: return
+        self.member_sync_at = now
+        self.send_packet(self.packet(protocol.MEMBER_SYNC))
+
+    def roster_changed(self):
+        self.fetch_avatars()
+        self.update_user_list()
+
+    def fetch_avatars(self):
+        for uid, record in self.members.records.items():
+            self.peer_avatars[uid] = record[3]
+            self.want_avatar(record[3])
+
+    def want_avatar(self, avatar, addr=None):
+        """Asks for an avatar image only when its hash isn't already in the store (clients ask the host)."""
+        if not avatar or self.avatar_store.has(avatar): return
+        now = time.time()
+        if now - self.avatar_requests.get(avatar, 0) < HEARTBEAT_INTERVAL: return
+        self.avatar_requests[avatar] = now
+        self.send_packet(self.packet(protocol.AVATAR_REQ, avatar), addr)
+
+    def handle_list(self, sender_uid, seq, payload, addr, data):
+        if self.is_host: return
+        try: self.members.load_snapshot(payload)
+        except ValueError: return
+        self.roster_changed()
+
+    def handle_member_delta(self, sender_uid, seq, payload, addr, data):
+        self.apply_member_delta(payload, False)
+
+    def handle_member_leave(self, sender_uid, seq, payload, addr, data):
+        self.apply_member_delta(payload, True)
+
+    def apply_member_delta(self, payload, removal):
+        if self.is_host: return
+        try: in_order = self.members.apply(payload, removal)
+        except ValueError: return
+        if in_order: self.roster_changed()
+        else: self.request_member_sync()
+
+    def handle_member_sum(self, sender_uid, seq, payload, addr, data):
+        if self.is_host or len(payload) < protocol.SUM_HEADER.size: return
+        version, checksum = protocol.SUM_HEADER.unpack_from(payload)
+        if version != self.members.version or checksum != self.members.checksum(): self.request_member_sync()
+        else: self.fetch_avatars() # Retries avatar requests that went unanswered
+
+    def handle_member_sync(self, sender_uid, seq, payload, addr, data):
+        if self.is_host and sender_uid in self.connected_peers:
+            self.send_packet(self.packet(protocol.LIST, self.members.snapshot(), sender="Host"), addr)
+
+    def handle_avatar_req(self, sender_uid, seq, payload, addr, data):
+        # Members only (the host, for a client): the reply is far bigger than the request
+        if self.is_host and sender_uid not in self.connected_peers: return
+        if not self.is_host and addr != self.current_target: return
+        avatar = payload.decode(errors='ignore')
+        image = self.avatar_store.get(avatar)
+        if image: self.send_packet(self.packet(protocol.AVATAR, avatar.encode() + image), addr)
+
+    def handle_avatar(self, sender_uid, seq, payload, addr, data):
+        # Raw image bytes after the fixed-size hash. Only images we asked for, from the host or a member,
+        # that hash to what they claim ever reach the disk
+        if self.is_host and sender_uid not in self.connected_peers: return
+        if not self.is_host and addr != self.current_target: return
+        avatar, image = payload[:avatars.HASH_SIZE].decode(errors='ignore'), payload[avatars.HASH_SIZE:]
+        if avatar not in self.avatar_requests or avatars.avatar_hash(image) != avatar: return
+        self.avatar_requests.pop(avatar, None)
+        self.avatar_store.put(image)
+        self.update_user_list()
+        self.app.update_all_chat_dps()
+
+    def handle_text(self, sender_uid, seq, payload, addr, data):
+        if self.is_host:
+            t_parts = protocol.split_fields(payload, 2)
+            if len(t_parts) != 2: return
+            nick, msg = t_parts
+            # Fanned out with the log id stamped in front, so clients know where to resume after a rejoin
+            msg_id = self.chat_logger.add_message(sender_uid, nick, msg) if self.chat_logger else 0
+            self.broadcast(self.packet(protocol.TEXT, protocol.fields(msg_id, nick, msg), sender=sender_uid), exclude_uid=sender_uid)
+        else:
+            t_parts = protocol.split_fields(payload, 3)
+            if len(t_parts) != 3: return
+            msg_id, nick, msg = t_parts
+            if msg_id.isdigit(): self.history_last = max(self.history_last, int(msg_id))
+        self.app.on_chat_received(sender_uid, nick, msg)
+
+    def handle_audio(self, sender_uid, seq, payload, addr, data):
+        if self.is_host: self.broadcast(data, exclude_uid=sender_uid)
+        if len(payload) < protocol.AUDIO_HEADER.size: return
+        codec_id, rate, ts = protocol.AUDIO_HEADER.unpack_from(payload)
+        buf = self.jitter_buffers.get(sender_uid)
+        if buf is None: buf = self.jitter_buffers[sender_uid] = jitter.JitterBuffer()
+        buf.put(seq, ts, (codec_id, rate, payload[protocol.AUDIO_HEADER.size:]))
+        if codec_id != protocol.COMFORT_NOISE: self.app.set_user_speaking(sender_uid)
+
+    def handle_video(self, sender_uid, seq, payload, addr, data):
+        if self.is_host: self.forward_video(sender_uid, data)
+        if self.watching_uid == sender_uid:
+            self.handle_video_chunk(sender_uid, payload)
+
+    def handle_video_report(self, sender_uid, seq, payload, addr, data):
+        if len(payload) < protocol.REPORT_HEADER.size: return
+        streamer_uid = payload[protocol.REPORT_HEADER.size:].decode(errors='ignore')
+        if streamer_uid == self.uid:
+            self.video_reports[sender_uid] = (time.time(), protocol.REPORT_HEADER.unpack_from(payload))
+        elif self.is_host and streamer_uid in self.connected_peers:
+            self.send_packet(data, self.connected_peers[streamer_uid]["addr"])
+
+    def recent_video_reports(self):
+        now = time.time()
+        return [r for r in self.video_reports.values() if now - r[0] < REPORT_TTL]
+
+    def report_video(self):
+        """Runs every REPORT_INTERVAL while watching, frames or not, so an outage reaches the streamer as loss."""
+        streamer_uid = self.watching_uid
+        if not streamer_uid or streamer_uid == self.uid: return
+        stats = self.video_frames.take_interval()
+        lost = stats["lost"] + stats["late"]
+        if not stats["completed"] and not lost:
+            if not self.video_seen: return # Stream hasn't reached us yet
+            lost = 1 # The streamer sends at least a frame a second, so a silent interval lost one at least
+        lag_ms = 1000 * stats["lag"] / stats["completed"] if stats["completed"] else 0
+        report = [min(int(v), 0xFFFF) for v in (stats["completed"], lost, stats["missing"], lag_ms)]
+        pkt = self.packet(protocol.VIDEO_REPORT, protocol.REPORT_HEADER.pack(*report) + streamer_uid.encode())
+        if not self.is_host: self.send_packet(pkt)
+        elif streamer_uid in self.connected_peers: self.send_packet(pkt, self.connected_peers[streamer_uid]["addr"])
+
+    def handle_watch(self, sender_uid, seq, payload, addr, data):
+        if not self.is_host: return
+        streamer_uid = payload.decode(errors='ignore')
+        if streamer_uid == sender_uid: return
+        self.stream_viewers.setdefault(streamer_uid, set()).add(sender_uid)
+        self.notify_viewer_count(streamer_uid)
+
+    def handle_unwatch(self, sender_uid, seq, payload, addr, data):
+        if not self.is_host: return
+        streamer_uid = payload.decode(errors='ignore')
+        self.stream_viewers.get(streamer_uid, set()).discard(sender_uid)
+        self.notify_viewer_count(streamer_uid)
+
+    def handle_viewers(self, sender_uid, seq, payload, addr, data):
+        if not self.is_host:
+            self.stream_viewer_count = int(payload)
+
+    def notify_viewer_count(self, streamer_uid):
+        count = len(self.stream_viewers.get(streamer_uid, ()))
+        peer = self.connected_peers.get(streamer_uid)
+        if streamer_uid == self.uid:
+            self.stream_viewer_count = count
+        elif peer:
+            self.send_packet(self.packet(protocol.VIEWERS, str(count), sender="Host"), peer["addr"])
+
+    def forward_video(self, streamer_uid, data):
+        # The host's own stream is sent from the capture engine's thread while the listener edits
+        # viewer sets and peers, so work from snapshots
+        for uid in tuple(self.stream_viewers.get(streamer_uid, ())):
+            peer = self.connected_peers.get(uid)
+            if uid != streamer_uid and uid != self.uid and peer:
+                self.send_packet(data, peer["addr"])
+
+    def watch_stream(self, streamer_uid):
+        if self.watching_uid and self.watching_uid != streamer_uid: self.stop_watching()
+        self.watching_uid = streamer_uid
+        self.video_frames.take_interval()
+        self.video_seen = False
+        if streamer_uid == self.uid: return # Own stream is previewed locally
+        if self.is_host:
+            self.stream_viewers.setdefault(streamer_uid, set()).add(self.uid)
+            self.notify_viewer_count(streamer_uid)
+        else:
+            self.send_packet(self.packet(protocol.WATCH, streamer_uid))
+
+    def stop_watching(self):
+        streamer_uid, self.watching_uid = self.watching_uid, None
+        if streamer_uid: self.video_frames.forget(streamer_uid)
+        if not streamer_uid or streamer_uid == self.uid: return
+        if self.is_host:
+            self.stream_viewers.get(streamer_uid, set()).discard(self.uid)
+            self.notify_viewer_count(streamer_uid)
+        else:
+            self.send_packet(self.packet(protocol.UNWATCH, streamer_uid))
 
-            except OSError:
-                break
-                
     def send_file(self, filepath):
+        senders = self.prepare_file_send(filepath)
+        if senders: self.run_senders(senders, os.path.basename(filepath))
+
+    def prepare_file_send(self, filepath, digest=None):
         filename = os.path.basename(filepath)
-        try:
-            with open(filepath, 'rb') as f:
-                file_bytes = f.read()
-        except: return
+        try: source = transfer.FileSource(filepath, digest)
+        except OSError: return None
         
         ext = filename.lower().split('.')[-1]
         
@@ -355,119 +707,264 @@ class NetworkNode:
                 self.chat_logger.add_message(self.uid, self.nickname, f"[VIDEO_PREVIEW]|{filepath}|{thumb}")
             else:
                 self.chat_logger.add_message(self.uid, self.nickname, f"📎 Shared a file: '{filename}'")
-            
-        chunks = [file_bytes[i:i + UDP_MAX_SIZE] for i in range(0, len(file_bytes), UDP_MAX_SIZE)]
-        total_chunks = len(chunks)
-        
-        for i, chunk in enumerate(chunks):
-            if i == total_chunks - 1: chunk += b"<-EOF->" 
-            data = f"FILE|{self.uid}|{filename}|{i}|".encode() + chunk
-            if self.is_host: self.broadcast(data)
-            else: self.send_packet(data)
-            time.sleep(0.01) 
 
-    def handle_file_chunk(self, sender_uid, filename, chunk_id, data):
-        is_eof = False
-        if data.endswith(b"<-EOF->"):
-            is_eof = True
-            data = data[:-7]
-            
-        file_key = f"{sender_uid}_{filename}"
-        if file_key not in self.video_buffer:
-            self.video_buffer[file_key] = {}
-            
-        self.video_buffer[file_key][chunk_id] = data
-        
-        if is_eof:
-            save_dir = "hub_downloads"
-            os.makedirs(save_dir, exist_ok=True)
-            save_path = os.path.join(save_dir, filename)
-            
+        return self.start_file_senders(transfer.new_transfer_id(), self.uid, filename, source)
+
+    def start_file_senders(self, xfer_id, origin_uid, filename, source, exclude_uid=None, dest_uids=None):
+        """Registers one windowed sender per destination: every peer (or dest_uids) when hosting, otherwise the host."""
+        if self.is_host:
+            dests = [(uid, peer["addr"]) for uid, peer in list(self.connected_peers.items())
+                     if uid not in (self.uid, exclude_uid) and (dest_uids is None or uid in dest_uids)]
+        elif self.current_target:
+            dests = [(None, self.current_target)]
+        else:
+            dests = []
+
+        offer = protocol.OFFER_HEADER.pack(xfer_id, source.chunk_count, source.size, bytes.fromhex(source.digest)) + filename.encode()
+        senders = []
+        with self.transfer_cond:
+            for dest_uid, dest_addr in dests:
+                sender = transfer.FileSender(xfer_id, source.chunk_count, dest_uid, dest_addr)
+                sender.origin_uid = origin_uid
+                sender.filename = filename
+                sender.offer = offer
+                sender.source = source
+                self.file_senders[(xfer_id, dest_uid)] = sender
+                senders.append(sender)
+        if not senders: source.close()
+        return senders
+
+    def run_senders(self, senders, progress_name=None):
+        while self.running:
+            with self.transfer_cond:
+                due, delay = self.pump_senders(senders)
+                wakes = self.transfer_wakes
+            # Chunks are read and sent outside the lock so acks aren't held up behind disk I/O
+            self.send_chunks(due)
+            self.report_senders_progress(senders, progress_name, delay)
+            if delay is None: break
+            with self.transfer_cond:
+                if self.transfer_wakes == wakes: self.transfer_cond.wait(delay)
+        with self.transfer_cond:
+            self.finish_senders(senders)
+
+    def finish_senders(self, senders):
+        source = senders[0].source
+        for s in senders:
+            self.file_senders.pop((s.xfer_id, s.dest_uid), None)
+            if s.dest_uid and not s.done:
+                # Peer dropped mid-transfer: offer it again (resuming from its partial) when it rejoins
+                self.pending_relays.setdefault(s.dest_uid, []).append((s.xfer_id, s.origin_uid, s.filename, source.path, source.digest))
+        source.close()
+
+    def pump_senders(self, senders):
+        """Picks what each sender's window and pacing allow; caller holds transfer_cond.
+        Returns ([(sender, chunk ids)], next wake-up delay or None when all are finished)."""
+        now = time.time()
+        due, delay = [], None
+        for s in senders:
+            chunk_ids, wake = s.poll(now)
+            if chunk_ids: due.append((s, chunk_ids))
+            if wake is not None: delay = wake if delay is None else min(delay, wake)
+        return due, delay
+
+    def send_chunks(self, due):
+        for s, chunk_ids in due:
+            for chunk_id in chunk_ids:
+                if chunk_id == transfer.OFFER_CHUNK:
+                    data = self.packet(protocol.FILE_OFFER, s.offer, sender=s.origin_uid)
+                else:
+                    data = self.packet(protocol.FILE, protocol.FILE_HEADER.pack(s.xfer_id, chunk_id) + s.source.read_chunk(chunk_id), sender=s.origin_uid)
+                self.send_packet(data, s.dest_addr)
+
+    def report_senders_progress(self, senders, progress_name, delay):
+        if progress_name and senders:
+            done = min(s.acked_count for s in senders)
+            self.report_transfer_progress("up", progress_name, done, senders[0].chunk_count, finished=delay is None)
+
+    def wake_senders(self):
+        self.transfer_wakes += 1
+        self.transfer_cond.notify_all()
+
+    def relay_file(self, xfer_id, origin_uid, filename, path, digest, dest_uids=None):
+        try: source = transfer.FileSource(path, digest)
+        except OSError: return
+        senders = self.start_file_senders(xfer_id, origin_uid, filename, source, exclude_uid=origin_uid, dest_uids=dest_uids)
+        if senders: threading.Thread(target=self.run_senders, args=(senders,), daemon=True).start()
+
+    def resume_relays(self, uid):
+        for xfer_id, origin_uid, filename, path, digest in self.pending_relays.pop(uid, []):
+            self.relay_file(xfer_id, origin_uid, filename, path, digest, dest_uids=[uid])
+
+    def run_background(self, func, *args):
+        threading.Thread(target=func, args=args, daemon=True).start()
+
+    def call_in_network(self, func, *args):
+        func(*args)
+
+    def report_transfer_progress(self, direction, filename, done_chunks, total_chunks, finished=False):
+        key = (direction, filename)
+        now = time.time()
+        if not finished and now - self.progress_times.get(key, 0) < 0.25: return
+        self.progress_times[key] = now
+        if finished: self.progress_times.pop(key, None)
+        percent = 100 if not total_chunks else int(done_chunks * 100 / total_chunks)
+        self.app.on_transfer_progress(direction, filename, percent)
+
+    def handle_file_offer(self, sender_uid, seq, payload, addr, data):
+        if len(payload) < protocol.OFFER_HEADER.size: return
+        # Offers come from members (the host, for a client) and must describe a file within the room limit
+        if self.is_host and sender_uid not in self.connected_peers: return
+        if not self.is_host and addr != self.current_target: return
+        xfer_id, chunk_count, file_size, digest = protocol.OFFER_HEADER.unpack_from(payload)
+        if file_size > self.file_size_limit_mb * 1024 * 1024: return
+        if chunk_count != -(-file_size // transfer.FILE_CHUNK_SIZE): return
+        digest = digest.hex()
+        filename = os.path.basename(payload[protocol.OFFER_HEADER.size:].decode(errors='ignore')) or "file"
+        key = (sender_uid, xfer_id)
+        receiver = self.file_receivers.get(key)
+        if receiver is None:
+            # A blob already arriving from someone else is joined, not opened a second time; the ack shows what it holds
+            receiver = self.partial_receivers.get(digest)
+            if receiver is not None and receiver.file_size != file_size: return
+        if receiver is None:
             try:
-                with open(save_path, 'wb') as f:
-                    for i in range(len(self.video_buffer[file_key])):
-                        f.write(self.video_buffer[file_key][i])
-                        
-                nick = self.connected_peers.get(sender_uid, {}).get("nick", "Someone")
-                if sender_uid == self.uid: nick = self.nickname
-                    
-                ext = filename.lower().split('.')[-1]
-                if ext in ['png', 'jpg', 'jpeg', 'gif', 'bmp']:
-                    msg = f"[IMAGE_PREVIEW]|{save_path}"
-                elif ext in ['mp4', 'mkv', 'avi', 'mov']:
-                    thumb_img = self.app.media.extract_video_frame(save_path)
-                    thumb_path = ""
-                    if thumb_img:
-                        os.makedirs("thumbnails", exist_ok=True)
-                        thumb_path = os.path.join("thumbnails", f"temp_thumb_recv_{int(time.time())}.jpg")
-                        thumb_img.save(thumb_path)
-                    msg = f"[VIDEO_PREVIEW]|{save_path}|{thumb_path}"
+                if self.file_cache.has(digest): # Already hold the blob: ack everything, skip the transfer
+                    receiver = transfer.FileReceiver(xfer_id, filename, file_size, chunk_count, digest)
                 else:
-                    msg = f"📎 Shared a file: '{filename}' (Saved to {save_dir}/)"
-                    
-                self.app.on_chat_received(sender_uid, nick, msg)
-                if self.is_host and self.chat_logger: self.chat_logger.add_message(sender_uid, nick, msg)
-            except: pass
-            del self.video_buffer[file_key]
-
-    def handle_video_chunk(self, payload):
-        parts = payload.split(b'|', maxsplit=3)
-        if len(parts) < 4: return
+                    part_path, map_path = self.file_cache.partial_paths(digest)
+                    receiver = transfer.FileReceiver(xfer_id, filename, file_size, chunk_count, digest, part_path, map_path)
+                    self.partial_receivers[digest] = receiver
+            except OSError: return
+        if key not in self.file_receivers:
+            self.file_receivers[key] = receiver
+            if receiver.complete: self.finish_file(receiver)
+        ack = protocol.ACK_HEADER.pack(xfer_id, receiver.cum, transfer.OFFER_CHUNK) + receiver.bitmap(full=True)
+        self.send_packet(self.packet(protocol.FILE_ACK, ack), addr)
+
+    def handle_file(self, sender_uid, seq, payload, addr, data):
+        if len(payload) < protocol.FILE_HEADER.size: return
+        xfer_id, chunk_id = protocol.FILE_HEADER.unpack_from(payload)
+        receiver = self.file_receivers.get((sender_uid, xfer_id))
+        if receiver is None: return # Offer not seen yet; the sender retransmits after our ACK
+        if receiver.add(chunk_id, payload[protocol.FILE_HEADER.size:]):
+            if receiver.complete: self.finish_file(receiver)
+            else: self.report_transfer_progress("down", receiver.filename, receiver.received_count, receiver.chunk_count)
+        ack = protocol.ACK_HEADER.pack(xfer_id, receiver.cum, chunk_id) + receiver.bitmap()
+        self.send_packet(self.packet(protocol.FILE_ACK, ack), addr)
+
+    def handle_file_ack(self, sender_uid, seq, payload, addr, data):
+        if len(payload) < protocol.ACK_HEADER.size: return
+        xfer_id, cum, echo = protocol.ACK_HEADER.unpack_from(payload)
+        with self.transfer_cond:
+            sender = self.file_senders.get((xfer_id, sender_uid)) or self.file_senders.get((xfer_id, None))
+            if sender is None: return
+            sender.on_ack(cum, echo, payload[protocol.ACK_HEADER.size:], time.time())
+            self.wake_senders()
+
+    def finish_file(self, receiver):
+        if receiver.finished: return
+        receiver.finished = True
+        receiver.close()
+        if self.partial_receivers.get(receiver.digest) is receiver: del self.partial_receivers[receiver.digest]
+        offers = [key for key, r in self.file_receivers.items() if r is receiver] # Everyone who offered this blob
+        self.report_transfer_progress("down", receiver.filename, receiver.chunk_count, receiver.chunk_count, finished=True)
+        # Hashing a large file would stall the listener, so verify and store off-thread
+        self.run_background(self.store_received_file, offers, receiver)
+
+    def store_received_file(self, offers, receiver):
         try:
-            frame_id, total_chunks, chunk_id = int(parts[0]), int(parts[1]), int(parts[2])
-            chunk_data = parts[3]
-        except ValueError: return
-
-        if frame_id not in self.video_buffer:
-            old_keys = [k for k in self.video_buffer.keys() if isinstance(k, int) and k < frame_id - 5]
-            for k in old_keys: del self.video_buffer[k]
-            self.video_buffer[frame_id] = {'total': total_chunks, 'chunks': {}, 'time': time.time()}
-
-        self.video_buffer[frame_id]['chunks'][chunk_id] = chunk_data
+            if receiver.part_path:
+                if transfer.file_digest(receiver.part_path) != receiver.digest:
+                    receiver.discard()
+                    self.app.on_chat_received("SYSTEM", "System", f"⚠️ '{receiver.filename}' failed its integrity check and was discarded.")
+                    return
+                self.file_cache.store(receiver.digest, receiver.part_path)
+            save_path = self.file_cache.export(receiver.digest, receiver.filename, DOWNLOAD_DIR)
+        except OSError: return
+        for sender_uid, xfer_id in offers:
+            self.announce_received_file(sender_uid, receiver.filename, save_path)
+            if self.is_host:
+                self.call_in_network(self.relay_file, xfer_id, sender_uid, receiver.filename, self.file_cache.blob_path(receiver.digest), receiver.digest)
+
+    def expire_transfers(self):
+        now = time.time()
+        for key, receiver in list(self.file_receivers.items()):
+            if now - receiver.last_activity > transfer.STALL_TIMEOUT:
+                del self.file_receivers[key]
+                # Offers of one blob share an unfinished receiver: suspend it once, keeping the partial so a re-offer resumes
+                if self.partial_receivers.get(receiver.digest) is receiver:
+                    del self.partial_receivers[receiver.digest]
+                    receiver.suspend()
+
+    def announce_received_file(self, sender_uid, filename, save_path):
+        try:
+            nick = self.connected_peers.get(sender_uid, {}).get("nick", "Someone")
+            if sender_uid == self.uid: nick = self.nickname
+                
+            ext = filename.lower().split('.')[-1]
+            if ext in ['png', 'jpg', 'jpeg', 'gif', 'bmp']:
+                msg = f"[IMAGE_PREVIEW]|{save_path}"
+            elif ext in ['mp4', 'mkv', 'avi', 'mov']:
+                thumb_img = self.app.media.extract_video_frame(save_path)
+                thumb_path = ""
+                if thumb_img:
+                    os.makedirs("thumbnails", exist_ok=True)
+                    thumb_path = os.path.join("thumbnails", f"temp_thumb_recv_{int(time.time())}.jpg")
+                    thumb_img.save(thumb_path)
+                msg = f"[VIDEO_PREVIEW]|{save_path}|{thumb_path}"
+            else:
+                msg = f"📎 Shared a file: '{filename}' (Saved to {DOWNLOAD_DIR}/)"
+                
+            self.app.on_chat_received(sender_uid, nick, msg)
+            if self.is_host and self.chat_logger: self.chat_logger.add_message(sender_uid, nick, msg)
+        except: pass
 
-        if len(self.video_buffer[frame_id]['chunks']) == total_chunks:
-            full_jpg = b''.join([self.video_buffer[frame_id]['chunks'][i] for i in range(total_chunks)])
-            self.app.render_video_frame(full_jpg)
-            del self.video_buffer[frame_id]
+    def handle_video_chunk(self, sender_uid, payload):
+        if len(payload) < protocol.VIDEO_HEADER.size: return
+        frame_id, data_count, parity, chunk_id, frame_size, epoch = protocol.VIDEO_HEADER.unpack_from(payload)
+        frame = self.video_frames.add(sender_uid, frame_id, data_count, parity, chunk_id, frame_size, payload[protocol.VIDEO_HEADER.size:], epoch=epoch)
+        if frame: self.app.render_video_frame(frame)
+        self.video_seen = True
 
     def update_user_list(self):
-        if self.is_host:
-            user_data = []
-            for uid, peer in self.connected_peers.items():
-                live_str = "1" if peer["is_live"] else "0"
-                dp_str = self.dp_cache.get(uid, "")
-                bio = peer.get('bio', '')
-                user_data.append(f"{uid}:{peer['nick']}:{live_str}:{dp_str}:{bio}")
-            
-            payload = ",".join(user_data)
-            self.broadcast(f"LIST|Host|{payload}".encode())
-            
-            parsed = [u.split(':', 4) for u in user_data]
-            self.app.update_user_list_ui(parsed)
+        # Local UI only; peers learn about roster changes through membership deltas
+        parsed = []
+        for uid, nick, live, avatar, bio, is_host in self.members.records.values():
+            parsed.append([uid, nick, "1" if live else "0", self.avatar_store.b64(avatar), bio, bool(is_host)])
+        self.app.update_user_list_ui(parsed)
 
     def send_text(self, text):
-        data = f"T|{self.uid}|{self.nickname}|{text}".encode()
         if self.is_host: 
-            if self.chat_logger: self.chat_logger.add_message(self.uid, self.nickname, text)
-            self.broadcast(data)
+            msg_id = self.chat_logger.add_message(self.uid, self.nickname, text) if self.chat_logger else 0
+            self.broadcast(self.packet(protocol.TEXT, protocol.fields(msg_id, self.nickname, text)))
         else: 
-            self.send_packet(data)
+            self.send_packet(self.packet(protocol.TEXT, protocol.fields(self.nickname, text)))
 
-    def send_audio(self, audio_bytes):
-        data = f"A|{self.uid}|".encode() + audio_bytes
+    def send_audio(self, frame, codec_id, rate, capture_ms=None):
+        if capture_ms is None: capture_ms = int(time.time() * 1000)
+        data = self.packet(protocol.AUDIO, protocol.AUDIO_HEADER.pack(codec_id, rate, capture_ms & 0xFFFFFFFF) + frame)
         if self.is_host: self.broadcast(data)
         else: self.send_packet(data)
 
-    def send_video_frame(self, frame_id, jpeg_bytes):
-        chunks = [jpeg_bytes[i:i + UDP_MAX_SIZE] for i in range(0, len(jpeg_bytes), UDP_MAX_SIZE)]
+    def send_video_frame(self, frame_id, frame):
+        if self.stream_viewer_count == 0: return # Nobody subscribed, don't spend uplink
+        # Even split, so the receiver can work out every chunk's length from the frame size when rebuilding one
+        count = max(1, -(-len(frame) // VIDEO_CHUNK_SIZE))
+        size = -(-len(frame) // count)
+        chunks = [frame[i * size:(i + 1) * size] for i in range(count)]
+        parity = fec.parity_count(count, self.video_fec)
+        chunks += fec.parity_chunks(chunks, parity)
         for i, chunk in enumerate(chunks):
-            data = f"V|{self.uid}|{frame_id}|{len(chunks)}|{i}|".encode() + chunk
-            if self.is_host: self.broadcast(data)
+            data = self.packet(protocol.VIDEO, protocol.VIDEO_HEADER.pack(frame_id, count, parity, i, len(frame), self.video_epoch) + chunk)
+            if self.is_host: self.forward_video(self.uid, data)
             else: self.send_packet(data)
 
     def shutdown(self):
         self.running = False
-        leave_pkt = f"LEAVE|{self.uid}".encode()
+        if self.chat_logger: self.chat_logger.close()
+        self.control.flush(force=True)
+        leave_pkt = self.packet(protocol.LEAVE)
         if self.is_host:
             self.broadcast(leave_pkt)
         elif self.current_target:
@@ -0,0 +1,138 @@
+import asyncio
+import os
+import threading
+import protocol
+import transfer
+from network import NetworkNode, HEARTBEAT_INTERVAL, REPORT_INTERVAL
+
+class _DatagramHandler(asyncio.DatagramProtocol):
+    def __init__(self, node):
+        self.node = node
+
+    def datagram_received(self, data, addr):
+        self.node.handle_datagram(data, addr)
+
+    def error_received(self, exc):
+        pass # ICMP port-unreachable from a departed peer, same as the threaded engine ignoring it
+
+class AsyncNetworkNode(NetworkNode):
+    """Same API as NetworkNode, but receive, heartbeats and file sends run on one asyncio loop
+    instead of the listener/heartbeat threads. Sends from other threads are handed to the loop."""
+    def __init__(self, app_callback, config):
+        super().__init__(app_callback, config)
+        self.loop = None
+        self.transport = None
+        self.loop_thread_id = None
+        self.transfer_events = set() # One per running sender task, so a wake reaches all of them
+        self.control.on_pending = self.schedule_control_flush
+
+    def start_threads(self):
+        ready = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.run_loop, args=(ready,), daemon=True).start()
+        ready.wait(timeout=2.0)
+
+    def run_loop(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.loop_thread_id = threading.get_ident()
+        try:
+            self.transport, _ = self.loop.run_until_complete(
+                self.loop.create_datagram_endpoint(lambda: _DatagramHandler(self), sock=self.sock))
+            self.loop.call_later(HEARTBEAT_INTERVAL, self.heartbeat_timer)
+            self.loop.call_later(REPORT_INTERVAL, self.report_timer)
+        finally:
+            # Released from inside run_forever, so start_client's JOIN finds the loop running
+            if self.transport: self.loop.call_soon(ready.set)
+            else: ready.set()
+        if self.transport:
+            self.loop.run_forever()
+        self.loop.close()
+
+    def heartbeat_timer(self):
+        if not self.running: return
+        self.heartbeat_tick()
+        self.loop.call_later(HEARTBEAT_INTERVAL, self.heartbeat_timer)
+
+    def report_timer(self):
+        if not self.running: return
+        self.report_video()
+        self.loop.call_later(REPORT_INTERVAL, self.report_timer)
+
+    def send_datagram(self, data, target):
+        if threading.get_ident() == self.loop_thread_id: self.send_now(data, target)
+        else: self.call_in_loop(self.send_now, data, target)
+
+    def schedule_control_flush(self, delay):
+        # Batches are flushed by a loop timer rather than a flusher thread
+        self.call_in_loop(self.loop.call_later, delay, self.control.flush)
+
+    def call_in_loop(self, func, *args):
+        # Queues fine before run_forever starts; only a closed loop drops the call
+        if not self.loop or self.loop.is_closed(): return
+        try: self.loop.call_soon_threadsafe(func, *args)
+        except RuntimeError: pass
+
+    def send_now(self, data, target):
+        try:
+            if self.transport and not self.transport.is_closing(): self.transport.sendto(data, target)
+        except: pass
+
+    def send_file(self, filepath):
+        # Blocks the calling (upload) thread until the loop task finishes, like the threaded engine.
+        # The digest is computed here so hashing never stalls the loop.
+        if not self.loop or self.loop.is_closed(): return
+        try: digest = transfer.file_digest(filepath)
+        except OSError: return
+        task = asyncio.run_coroutine_threadsafe(self.send_file_task(filepath, digest), self.loop)
+        try: task.result()
+        except: pass
+
+    async def send_file_task(self, filepath, digest=None):
+        senders = self.prepare_file_send(filepath, digest)
+        if senders: await self.run_senders_task(senders, os.path.basename(filepath))
+
+    async def run_senders_task(self, senders, progress_name=None):
+        # Acks are handled on this same loop, so the transfer lock is never contended here
+        event = asyncio.Event()
+        self.transfer_events.add(event)
+        try:
+            while self.running:
+                with self.transfer_cond:
+                    due, delay = self.pump_senders(senders)
+                self.send_chunks(due)
+                self.report_senders_progress(senders, progress_name, delay)
+                if delay is None: break
+                event.clear()
+                try: await asyncio.wait_for(event.wait(), delay)
+                except asyncio.TimeoutError: pass
+        finally: self.transfer_events.discard(event)
+        with self.transfer_cond:
+            self.finish_senders(senders)
+
+    def wake_senders(self):
+        super().wake_senders()
+        for event in self.transfer_events: event.set()
+
+    def relay_file(self, xfer_id, origin_uid, filename, path, digest, dest_uids=None):
+        try: source = transfer.FileSource(path, digest)
+        except OSError: return
+        senders = self.start_file_senders(xfer_id, origin_uid, filename, source, exclude_uid=origin_uid, dest_uids=dest_uids)
+        if senders: self.loop.create_task(self.run_senders_task(senders))
+
+    def call_in_network(self, func, *args):
+        self.loop.call_soon_threadsafe(func, *args)
+
+    def shutdown(self):
+        self.running = False
+        if self.chat_logger: self.chat_logger.close()
+        if not self.loop or not self.loop.is_running():
+            return super().shutdown()
+        leave_pkt = self.packet(protocol.LEAVE)
+        self.loop.call_soon_threadsafe(self.close_loop, leave_pkt)
+
+    def close_loop(self, leave_pkt):
+        self.control.flush(force=True)
+        if self.is_host: self.broadcast(leave_pkt)
+        elif self.current_target: self.send_now(leave_pkt, self.current_target)
+        self.transport.close()
+        self.loop.stop()
@@ -0,0 +1,106 @@
+import json
+import zlib
+import struct
+
+# Wire header: version, packet type, sender uid (null padded), per-type sequence, payload length
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!BB18sIH")
+HEADER_SIZE = HEADER.size
+UID_SIZE = 18
+
+# Packet types
+BEAT = 1
+JOIN = 2
+LEAVE = 3
+LIMIT = 4
+REQ_SEC = 5
+SEC_ACCEPT = 6
+NEW_SEC_HOST = 7
+MIGRATE = 8
+HISTORY = 9
+PROFILE = 10
+ACCEPT = 11
+REJECT = 12
+STREAM_START = 13
+STREAM_STOP = 14
+LIST = 15
+TEXT = 16
+FILE = 17
+AUDIO = 18
+VIDEO = 19
+WATCH = 20
+UNWATCH = 21
+VIEWERS = 22
+FILE_OFFER = 23
+FILE_ACK = 24
+MEMBER_JOIN = 25
+MEMBER_UPDATE = 26
+MEMBER_LEAVE = 27
+MEMBER_SUM = 28
+MEMBER_SYNC = 29
+AVATAR_REQ = 30
+AVATAR = 31
+VIDEO_REPORT = 32
+HISTORY_REQ = 33
+BUNDLE = 34
+
+# Chat and roster traffic, coalesced per peer into BUNDLE datagrams (see control.py)
+CONTROL_TYPES = frozenset((TEXT, PROFILE, LIST, HISTORY, MEMBER_JOIN, MEMBER_UPDATE, MEMBER_LEAVE, MEMBER_SUM, AVATAR))
+
+# Media sub-headers
+VIDEO_HEADER = struct.Struct("!HHHHIB") # frame_id, data chunks, parity chunks, chunk_id (parity after data), frame size, stream epoch
+FILE_HEADER = struct.Struct("!II")    # xfer_id, chunk_id (data follows)
+OFFER_HEADER = struct.Struct("!IIQ32s") # xfer_id, chunk_count, file_size, sha256 (filename follows)
+ACK_HEADER = struct.Struct("!IIi")    # xfer_id, cumulative ack, echoed chunk_id (NACK bitmap follows)
+SUM_HEADER = struct.Struct("!II")     # membership version, roster crc32
+REPORT_HEADER = struct.Struct("!HHHH") # frames completed, frames lost, chunks missing, reassembly lag ms (streamer uid follows)
+HISTORY_HEADER = struct.Struct("!B")   # history page flags (zlib'd JSON rows follow)
+HISTORY_REQ_HEADER = struct.Struct("!I") # oldest message id the client already has
+AUDIO_HEADER = struct.Struct("!BHI")  # codec id, sample rate, capture timestamp in ms (voice frame follows)
+BUNDLE_HEADER = struct.Struct("!BHHH") # flags, bundle id, fragment index, fragment count (bundle bytes follow)
+BUNDLE_LEN = struct.Struct("!H")       # length of each packet inside a bundle
+
+# Screen-share frame body (what VIDEO chunks reassemble into): a frame header, then JPEG regions
+VFRAME_HEADER = struct.Struct("!BHH")   # flags, frame width, frame height
+VREGION_HEADER = struct.Struct("!HHHHI") # x, y, width, height, jpeg length (jpeg follows)
+VFRAME_KEY = 1 # Flag: the regions cover the whole frame, so a viewer can start from here
+VIDEO_FRAME_IDS = 10000 # Frame ids wrap here
+
+# Voice codecs in the host's preference order; names are negotiated in JOIN/ACCEPT, ids go on the wire
+VOICE_CODECS = {"adpcm": 2, "mulaw": 1, "pcm": 0}
+COMFORT_NOISE = 255 # Codec id for a DTX silence marker; the payload is one noise-level byte (-dBov)
+
+HISTORY_MORE = 1  # Older messages exist before this page
+HISTORY_OLDER = 2 # Answers a HISTORY_REQ, so the page goes above what the client shows
+HISTORY_LAST = 4  # Final page of one reply; only this one carries HISTORY_MORE
+
+BUNDLE_ZLIB = 1 # The bundle's packets are zlib-compressed as a whole
+
+def pack(p_type, sender_uid, seq, payload=b""):
+    uid = sender_uid.encode() if isinstance(sender_uid, str) else sender_uid
+    return HEADER.pack(PROTOCOL_VERSION, p_type, uid, seq & 0xFFFFFFFF, len(payload)) + payload
+
+def unpack(data):
+    """Returns (p_type, sender_uid, seq, payload) or None for foreign / truncated datagrams."""
+    if len(data) < HEADER_SIZE: return None
+    version, p_type, uid, seq, length = HEADER.unpack_from(data)
+    if version != PROTOCOL_VERSION or len(data) < HEADER_SIZE + length: return None
+    return p_type, uid.rstrip(b"\0").decode(errors="ignore"), seq, data[HEADER_SIZE:HEADER_SIZE + length]
+
+def fields(*values):
+    """Joins text fields into a pipe-delimited control payload."""
+    return "|".join(str(v) for v in values).encode()
+
+def pack_history(rows, flags=0):
+    """rows: chat log dicts -> one HISTORY payload of [id, ts, uid, nick, msg] lists."""
+    body = json.dumps([[r["id"], r["ts"], r["uid"], r["nick"], r["msg"]] for r in rows], separators=(",", ":"))
+    return HISTORY_HEADER.pack(flags) + zlib.compress(body.encode())
+
+def unpack_history(payload):
+    flags, = HISTORY_HEADER.unpack_from(payload)
+    rows = json.loads(zlib.decompress(payload[HISTORY_HEADER.size:]))
+    return flags, [{"id": r[0], "ts": r[1], "uid": r[2], "nick": r[3], "msg": r[4]} for r in rows]
+
+def split_fields(payload, count):
+    parts = payload.split(b"|", maxsplit=count - 1)
+    return [p.decode(errors="ignore") for p in parts]
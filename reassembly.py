@@ -0,0 +1,138 @@
+import time
+import threading
+from collections import OrderedDict
+import fec
+import protocol
+
+MAX_FRAMES = 32 # Frames in flight across all senders, finished ones included until they age out
+MAX_BYTES = 16 * 1024 * 1024
+FRAME_TIMEOUT = 1.0 # A frame still missing chunks after this is given up on
+RESYNC_GAP = 300 # Ids further than this from the last frame shown mean the sender restarted its stream
+
+def frame_diff(a, b):
+    """a - b for frame ids that wrap at protocol.VIDEO_FRAME_IDS."""
+    half = protocol.VIDEO_FRAME_IDS // 2
+    return (a - b + half) % protocol.VIDEO_FRAME_IDS - half
+
+class PartialFrame:
+    __slots__ = ("data_count", "parity", "size", "chunks", "bytes", "started", "done")
+    def __init__(self, data_count, parity, size, started):
+        self.data_count = data_count
+        self.parity = parity
+        self.size = size
+        self.chunks = {}
+        self.bytes = 0
+        self.started = started
+        self.done = False
+
+    def missing(self):
+        return sum(1 for i in range(self.data_count) if i not in self.chunks)
+
+class FrameReassembler:
+    """Rebuilds video frames from VIDEO chunks, keyed by (sender, frame_id).
+    At most MAX_FRAMES entries and MAX_BYTES of chunk data are held; the oldest entries go first and
+    anything older than FRAME_TIMEOUT is dropped. Frames are released strictly in order per sender:
+    delta frames paint over the one before, so a frame completing after a newer one was shown is late.
+    Finished frames stay as empty markers until they age out, so trailing parity doesn't restart them."""
+    def __init__(self, slots=MAX_FRAMES, max_bytes=MAX_BYTES, timeout=FRAME_TIMEOUT):
+        self.slots = slots
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.frames = OrderedDict() # (sender, frame_id) -> PartialFrame, oldest first
+        self.bytes = 0
+        self.shown = {} # sender -> frame id of the newest frame released
+        self.epochs = {} # sender -> stream epoch of its latest chunk
+        self.stats = {"completed": 0, "recovered": 0, "late": 0, "incomplete": 0, "lost": 0, "missing": 0, "lag": 0.0}
+        self.interval = dict(self.stats)
+
+    def add(self, sender, frame_id, data_count, parity, chunk_id, frame_size, chunk, now=None, epoch=None):
+        """Stores one chunk; returns the frame body once it is complete and still current, else None.
+        A new epoch means the sender restarted its stream and frame ids with it, so its old state goes."""
+        now = time.time() if now is None else now
+        with self.lock:
+            if epoch is not None:
+                if self.epochs.get(sender, epoch) != epoch: self.reset(sender)
+                self.epochs[sender] = epoch
+            return self.store(sender, frame_id, data_count, parity, chunk_id, frame_size, chunk, now)
+
+    def store(self, sender, frame_id, data_count, parity, chunk_id, frame_size, chunk, now):
+        self.expire(now)
+        if not data_count or chunk_id >= data_count + parity or frame_size > self.max_bytes: return None
+        key = (sender, frame_id)
+        entry = self.frames.get(key)
+        if entry is None:
+            entry = self.frames[key] = PartialFrame(data_count, parity, frame_size, now)
+            if self.is_late(sender, frame_id):
+                entry.done = True
+                self.count("late")
+        if entry.done or chunk_id in entry.chunks: return None
+
+        entry.chunks[chunk_id] = chunk
+        entry.bytes += len(chunk)
+        self.bytes += len(chunk)
+        self.trim()
+        if key not in self.frames: return None
+        complete = all(i in entry.chunks for i in range(data_count))
+        if not complete and len(entry.chunks) >= data_count:
+            complete = fec.recover(entry.chunks, data_count, parity, frame_size)
+            if complete: self.count("recovered")
+        if not complete: return None
+
+        frame = b"".join(entry.chunks[i] for i in range(data_count))
+        self.finish(entry)
+        if self.is_late(sender, frame_id):
+            self.count("late")
+            return None
+        ahead = frame_diff(frame_id, self.shown[sender]) if sender in self.shown else 0
+        if 0 < ahead < RESYNC_GAP: self.count("lost", ahead - 1) # Ids skipped since the last frame shown never completed
+        self.shown[sender] = frame_id
+        self.count("completed")
+        self.count("lag", now - entry.started)
+        return frame
+
+    def is_late(self, sender, frame_id):
+        last = self.shown.get(sender)
+        return last is not None and -RESYNC_GAP < frame_diff(frame_id, last) <= 0
+
+    def finish(self, entry):
+        self.bytes -= entry.bytes
+        entry.chunks, entry.bytes, entry.done = {}, 0, True
+
+    def drop(self, key):
+        entry = self.frames.pop(key)
+        if entry.done: return
+        self.count("incomplete")
+        self.count("missing", entry.missing())
+        self.bytes -= entry.bytes
+
+    def trim(self):
+        while self.frames and (len(self.frames) > self.slots or self.bytes > self.max_bytes):
+            self.drop(next(iter(self.frames)))
+
+    def expire(self, now):
+        while self.frames:
+            key, entry = next(iter(self.frames.items()))
+            if now - entry.started <= self.timeout: break
+            self.drop(key)
+
+    def forget(self, sender):
+        """Drops everything held for sender, e.g. when the viewer switches streams."""
+        with self.lock:
+            self.reset(sender)
+            self.epochs.pop(sender, None)
+
+    def reset(self, sender):
+        for key in [k for k in self.frames if k[0] == sender]:
+            entry = self.frames.pop(key)
+            self.bytes -= entry.bytes
+        self.shown.pop(sender, None)
+
+    def count(self, stat, amount=1):
+        self.stats[stat] += amount
+        self.interval[stat] += amount
+
+    def take_interval(self):
+        """Counters since the previous call, for reception reports."""
+        with self.lock: interval, self.interval = self.interval, dict.fromkeys(self.stats, 0)
+        return interval
@@ -0,0 +1,197 @@
+import time
+import queue
+import threading
+from media import ScreenGrabber, scale_frame
+try:
+    import pygetwindow as gw
+except ImportError:
+    gw = None
+
+WINDOW_REFRESH = 0.5 # Seconds between pygetwindow lookups; moves and resizes show up within this
+STAGE_TIMEOUT = 0.2
+
+# Bitrate ladder, best first: (jpeg quality, share of max width, share of requested fps).
+# Quality goes first since it's invisible-ish, then frame rate, and resolution only as a last resort.
+VIDEO_LADDER = ((60, 1.0, 1.0), (50, 1.0, 1.0), (40, 1.0, 1.0), (32, 1.0, 0.75), (25, 1.0, 0.5),
+                (25, 0.75, 0.5), (20, 0.75, 0.33), (20, 0.5, 0.25))
+START_LEVEL = 2
+LOSS_HIGH = 0.08 # Share of frames lost that counts as congestion
+LOSS_LOW = 0.02
+LAG_HIGH = 150 # ms between a frame's first and last chunk
+LAG_LOW = 60
+CLIMB_AFTER = 4 # Clean report rounds in a row before stepping back up
+DOWN_HOLD = 2.0 # Reports still describe the old rate for a while, so don't step down again straight away
+CONTROL_INTERVAL = 1.0
+
+def offer(q, item):
+    """Puts item on a bounded queue, discarding whatever is still waiting. Returns True if a frame was dropped."""
+    dropped = False
+    while True:
+        try:
+            q.put_nowait(item)
+            return dropped
+        except queue.Full:
+            try:
+                q.get_nowait()
+                dropped = True
+            except queue.Empty: pass
+
+class WindowTracker:
+    """Geometry of a shared window, looked up by title at most every WINDOW_REFRESH seconds."""
+    def __init__(self, title, refresh=WINDOW_REFRESH):
+        self.title = title
+        self.refresh = refresh
+        self.region = None
+        self.closed = gw is None
+        self.checked = 0.0
+
+    def poll(self, now=None):
+        """Capture region, or None while minimised; sets closed once the window is gone."""
+        now = time.time() if now is None else now
+        if self.closed or now - self.checked < self.refresh: return self.region
+        self.checked = now
+        try: windows = gw.getWindowsWithTitle(self.title)
+        except Exception: return self.region
+        if not windows:
+            self.closed, self.region = True, None
+            return None
+        w = windows[0]
+        self.region = {"top": w.top, "left": w.left, "width": w.width, "height": w.height} if w.width > 0 and w.height > 0 else None
+        return self.region
+
+class BitrateController:
+    """Moves along VIDEO_LADDER from viewer reception reports; the worst viewer sets the pace.
+    A congested round steps down at once, climbing back needs CLIMB_AFTER clean rounds."""
+    def __init__(self, fps, ladder=VIDEO_LADDER, level=START_LEVEL):
+        self.max_fps = fps
+        self.ladder = ladder
+        self.level = level
+        self.clean = 0
+        self.seen = 0.0
+        self.hold_until = 0.0
+
+    @property
+    def quality(self): return self.ladder[self.level][0]
+
+    @property
+    def scale(self): return self.ladder[self.level][1]
+
+    @property
+    def fps(self): return max(1.0, self.max_fps * self.ladder[self.level][2])
+
+    def update(self, reports, now=None):
+        """reports: [(received at, (completed, lost, missing chunks, lag ms))]. Returns True if the level moved."""
+        now = time.time() if now is None else now
+        fresh = [r for t, r in reports if t > self.seen]
+        if not fresh: return False
+        self.seen = max(t for t, _ in reports)
+        loss = max(lost / (completed + lost) if completed + lost else 0.0 for completed, lost, _, _ in fresh)
+        lag = max(r[3] for r in fresh)
+
+        if loss > LOSS_HIGH or lag > LAG_HIGH:
+            self.clean = 0
+            if now < self.hold_until or self.level == len(self.ladder) - 1: return False
+            self.level += 1
+            self.hold_until = now + DOWN_HOLD
+            return True
+        if loss > LOSS_LOW or lag > LAG_LOW:
+            self.clean = 0
+            return False
+        self.clean += 1
+        if self.clean < CLIMB_AFTER or self.level == 0: return False
+        self.clean = 0
+        self.level -= 1
+        return True
+
+class CaptureEngine:
+    """Screen-share pipeline: grab, encode and send run on their own threads, joined by one-slot queues.
+    A stage that falls behind only ever sees the newest frame, so stale frames are dropped instead of
+    queued and the grabber keeps its pace; latency stays around a frame per stage.
+    send(body) is called on the send thread; on_end(reason) once if the source disappears or send fails.
+    feedback() returns the viewers' recent reports for the bitrate controller."""
+    def __init__(self, encoder, send, fps, max_width=1280, monitor_idx=1, tracker=None, audience=None, on_end=None, feedback=None):
+        self.encoder = encoder
+        self.send = send
+        self.controller = BitrateController(fps)
+        self.feedback = feedback
+        self.max_width = max_width
+        self.monitor_idx = monitor_idx
+        self.tracker = tracker
+        self.audience = audience or (lambda: 1)
+        self.on_end = on_end
+        self.running = False
+        self.raw = queue.Queue(1)
+        self.encoded = queue.Queue(1)
+        self.viewers = 0
+        self.captured = self.sent = self.dropped = 0
+
+    def start(self):
+        self.running = True
+        for stage in (self.capture_loop, self.encode_loop, self.send_loop):
+            threading.Thread(target=stage, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def end(self, reason):
+        if not self.running: return
+        self.running = False
+        if self.on_end: self.on_end(reason)
+
+    def capture_loop(self):
+        grabber = None # mss handles are per-thread, so it is created here and kept for the whole stream
+        next_tick = next_control = time.time()
+        try:
+            while self.running:
+                now = time.time()
+                if now < next_tick: time.sleep(next_tick - now)
+                interval = 1.0 / self.controller.fps
+                next_tick = max(next_tick + interval, time.time() - interval)
+                if self.feedback and now >= next_control:
+                    next_control = now + CONTROL_INTERVAL
+                    self.controller.update(self.feedback())
+
+                # New viewers can only start from a keyframe; with nobody watching, skip the work
+                viewers = self.audience()
+                if viewers > self.viewers: self.encoder.force_key = True
+                self.viewers = viewers
+                if not viewers: continue
+
+                region = None
+                if self.tracker:
+                    region = self.tracker.poll()
+                    if self.tracker.closed:
+                        self.end("Stream ended: Window was closed.")
+                        break
+                    if region is None: continue
+                try:
+                    if grabber is None: grabber = ScreenGrabber()
+                    img = grabber.grab(region, self.monitor_idx)
+                except Exception: continue
+                self.captured += 1
+                if offer(self.raw, img): self.dropped += 1
+        finally:
+            if grabber: grabber.close()
+
+    def encode_loop(self):
+        while self.running:
+            try: img = self.raw.get(timeout=STAGE_TIMEOUT)
+            except queue.Empty: continue
+            controller = self.controller
+            width = int(min(img.shape[1], self.max_width) * controller.scale)
+            try: body = self.encoder.encode(scale_frame(img, width), controller.quality)
+            except Exception: continue
+            if body and offer(self.encoded, body):
+                # The dropped frame may carry regions the queued delta doesn't, so resync on the next one
+                self.dropped += 1
+                self.encoder.force_key = True
+
+    def send_loop(self):
+        while self.running:
+            try: body = self.encoded.get(timeout=STAGE_TIMEOUT)
+            except queue.Empty: continue
+            try: self.send(body)
+            except Exception:
+                self.end("Stream ended: connection lost.")
+                break
+            self.sent += 1
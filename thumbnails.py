@@ -0,0 +1,112 @@
+import os
+import queue
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageOps
+
+THUMB_DIR = "hub_thumbs"
+THUMB_SIZE = 520 # Longest side: twice the 260px chat preview, so it stays sharp on HiDPI screens
+THUMB_QUALITY = 80
+MAX_FILES = 2000
+MAX_BYTES = 128 * 1024 * 1024
+KEY_SIZE = 20
+
+def thumb_key(path):
+    """Key for path as it is now; editing or replacing the file (new mtime or size) gives a new key."""
+    st = os.stat(path)
+    return hashlib.sha1(f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}".encode()).hexdigest()[:KEY_SIZE]
+
+class ThumbnailCache:
+    """Downscaled JPEG previews of chat images under hub_thumbs/, named by thumb_key so each file version
+    is decoded once. url() answers straight away and queues the thumbnail for a background thread;
+    a request that arrives before it is done makes it on the spot. Least recently used files are
+    removed once the cache holds more than max_files or max_bytes."""
+    def __init__(self, root=THUMB_DIR, size=THUMB_SIZE, max_files=MAX_FILES, max_bytes=MAX_BYTES):
+        self.root = root
+        self.size = size
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.make_lock = threading.Lock() # One decode at a time; the worker and a request never duplicate work
+        self.files = OrderedDict() # key -> bytes on disk, least recently used first
+        self.bytes = 0
+        self.sources = {} # key -> source image, for thumbnails not made yet
+        self.pending = queue.Queue()
+        os.makedirs(root, exist_ok=True)
+        self.load()
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    def path(self, key):
+        return os.path.join(self.root, key + ".jpg")
+
+    def load(self):
+        try: names = [n for n in os.listdir(self.root) if n.endswith(".jpg")]
+        except OSError: return
+        entries = []
+        for name in names:
+            try: st = os.stat(os.path.join(self.root, name))
+            except OSError: continue
+            entries.append((st.st_mtime, name[:-4], st.st_size))
+        with self.lock:
+            for _, key, size in sorted(entries):
+                self.files[key] = size
+                self.bytes += size
+            self.evict()
+
+    def url(self, source):
+        """URL the page can load source's thumbnail from, or "" if source isn't a readable file."""
+        try: key = thumb_key(source)
+        except OSError: return ""
+        with self.lock:
+            known = key in self.files
+            if not known: self.sources[key] = source
+        if not known: self.pending.put(key)
+        return f"/thumb/{key}.jpg"
+
+    def get(self, key):
+        """Path of the thumbnail for key, made now if the worker hasn't got to it; None if unknown or unreadable."""
+        with self.lock:
+            if key in self.files:
+                self.files.move_to_end(key)
+                try: os.utime(self.path(key)) # Recency survives a restart
+                except OSError: pass
+                return self.path(key)
+        return self.make(key)
+
+    def worker(self):
+        while True: self.make(self.pending.get())
+
+    def make(self, key):
+        with self.make_lock:
+            with self.lock:
+                if key in self.files: return self.path(key)
+                source = self.sources.get(key)
+            if source is None: return None
+            size = self.render(source, self.path(key))
+            with self.lock:
+                self.sources.pop(key, None)
+                if size is None: return None
+                self.files[key] = size
+                self.bytes += size
+                self.evict()
+                return self.path(key) if key in self.files else None
+
+    def render(self, source, dest):
+        try:
+            with Image.open(source) as img:
+                img.draft("RGB", (self.size, self.size)) # JPEGs decode at a fraction of full size
+                thumb = ImageOps.exif_transpose(img)
+                thumb.thumbnail((self.size, self.size))
+                thumb.convert("RGB").save(dest + ".tmp", "JPEG", quality=THUMB_QUALITY)
+            os.replace(dest + ".tmp", dest)
+            return os.path.getsize(dest)
+        except Exception: return None # Not an image, truncated, or gone since url()
+
+    def evict(self):
+        # Caller holds the lock
+        while self.files and (len(self.files) > self.max_files or self.bytes > self.max_bytes):
+            key, size = self.files.popitem(last=False)
+            self.bytes -= size
+            try: os.remove(self.path(key))
+            except OSError: pass
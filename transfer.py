@@ -0,0 +1,370 @@
+import os
+import time
+import random
+import shutil
+import hashlib
+from collections import deque
+
+FILE_CHUNK_SIZE = 8192
+INITIAL_WINDOW = 8
+MAX_WINDOW = 256
+BITMAP_CHUNKS = MAX_WINDOW
+PACING_BURST = 4
+LOSS_BACKOFF = 0.7 # VPN links drop randomly, so back off gently on NACKed loss
+MIN_RTO = 0.2
+MAX_RTO = 5.0
+STALL_TIMEOUT = 30.0
+OFFER_CHUNK = -1
+CACHE_DIR = "hub_cache"
+PARTIAL_MAX_AGE = 7 * 24 * 3600
+CACHE_MAX_BYTES = 4 * 1024 ** 3
+MAP_SAVE_EVERY = 256
+
+def new_transfer_id():
+    return random.getrandbits(32)
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""): h.update(block)
+    return h.hexdigest()
+
+def unique_path(directory, filename):
+    base, ext = os.path.splitext(filename)
+    path, n = os.path.join(directory, filename), 1
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{base} ({n}){ext}")
+        n += 1
+    return path
+
+class ContentCache:
+    """Blobs stored by SHA-256 under hub_cache/<aa>/<digest>, with resumable partials in hub_cache/partial/.
+    Completed blobs are kept to max_bytes, least recently used going first; downloads exported as
+    hard links outlive their blob, copies were already separate files."""
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.partial_dir = os.path.join(root, "partial")
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self.prune_partials()
+        self.prune_blobs()
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        try: os.utime(self.blob_path(digest)) # A dedup hit counts as a use
+        except OSError: return False
+        return True
+
+    def partial_paths(self, digest):
+        return os.path.join(self.partial_dir, digest + ".part"), os.path.join(self.partial_dir, digest + ".map")
+
+    def store(self, digest, part_path):
+        blob = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        os.replace(part_path, blob)
+        try: os.remove(self.partial_paths(digest)[1])
+        except OSError: pass
+        self.prune_blobs(keep=digest)
+        return blob
+
+    def export(self, digest, filename, directory):
+        """Places a blob in the downloads folder without clobbering other files of the same name."""
+        os.makedirs(directory, exist_ok=True)
+        blob = self.blob_path(digest)
+        existing = os.path.join(directory, filename)
+        try:
+            if os.path.exists(existing) and os.path.samefile(existing, blob): return existing
+        except OSError: pass
+        path = unique_path(directory, filename)
+        try: os.link(blob, path)
+        except OSError: shutil.copyfile(blob, path)
+        return path
+
+    def prune_blobs(self, keep=None):
+        blobs = []
+        try: folders = [d for d in os.listdir(self.root) if d != "partial"]
+        except OSError: return
+        for folder in folders:
+            try: names = os.listdir(os.path.join(self.root, folder))
+            except OSError: continue
+            for name in names:
+                try: st = os.stat(os.path.join(self.root, folder, name))
+                except OSError: continue
+                blobs.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in blobs)
+        for _, size, digest in sorted(blobs):
+            if total <= self.max_bytes: break
+            if digest == keep: continue
+            try:
+                os.remove(self.blob_path(digest))
+                total -= size
+            except OSError: pass # Still open on Windows, e.g. being relayed; next time
+
+    def prune_partials(self):
+        now = time.time()
+        for name in os.listdir(self.partial_dir):
+            path = os.path.join(self.partial_dir, name)
+            try:
+                if now - os.path.getmtime(path) > PARTIAL_MAX_AGE: os.remove(path)
+            except OSError: pass
+
+class FileSource:
+    """Reads chunks lazily from disk; shared by every sender of the same file."""
+    def __init__(self, path, digest=None):
+        self.path = path
+        self.digest = digest or file_digest(path)
+        self.f = open(path, 'rb')
+        self.size = os.fstat(self.f.fileno()).st_size
+
+    @property
+    def chunk_count(self):
+        return (self.size + FILE_CHUNK_SIZE - 1) // FILE_CHUNK_SIZE
+
+    def read_chunk(self, chunk_id):
+        self.f.seek(chunk_id * FILE_CHUNK_SIZE)
+        return self.f.read(FILE_CHUNK_SIZE)
+
+    def close(self):
+        try: self.f.close()
+        except: pass
+
+class FileSender:
+    """Sliding-window sender for one file to one destination.
+    AIMD congestion window, sends paced over the smoothed RTT, retransmits on
+    receiver NACK bitmaps (fast) or RTO expiry (slow)."""
+    def __init__(self, xfer_id, chunk_count, dest_uid, dest_addr):
+        self.xfer_id = xfer_id
+        self.chunk_count = chunk_count
+        self.dest_uid = dest_uid
+        self.dest_addr = dest_addr
+
+        self.acked = bytearray(chunk_count)
+        self.acked_count = 0
+        self.cum = 0
+        self.next_new = 0
+        self.in_flight = {} # chunk_id -> (send_time, retransmitted), in send order
+        self.lost = deque()
+
+        self.offer_acked = False
+        self.offer_sent = 0.0
+        self.cwnd = float(INITIAL_WINDOW)
+        self.ssthresh = float(MAX_WINDOW)
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = 1.0
+        self.next_send = 0.0
+        self.last_cut = 0.0
+        self.last_progress = time.time()
+        self.failed = False
+
+    @property
+    def done(self):
+        return self.offer_acked and self.acked_count == self.chunk_count
+
+    def poll(self, now):
+        """Returns (chunk ids to transmit now, seconds until the next poll is needed or None when finished)."""
+        if self.done or self.failed: return [], None
+        if now - self.last_progress > STALL_TIMEOUT:
+            self.failed = True
+            return [], None
+
+        if not self.offer_acked:
+            if now - self.offer_sent < self.rto: return [], self.offer_sent + self.rto - now
+            self.offer_sent = now
+            return [OFFER_CHUNK], self.rto
+
+        self.expire(now)
+        out = []
+        gap = self.srtt / self.cwnd if self.srtt else 0.0
+        while len(self.in_flight) < int(self.cwnd) and now >= self.next_send:
+            chunk_id, retransmitted = self.pick()
+            if chunk_id is None: break
+            self.in_flight[chunk_id] = (now, retransmitted)
+            out.append(chunk_id)
+            if gap: self.next_send = max(self.next_send, now - PACING_BURST * gap) + gap
+
+        wake = STALL_TIMEOUT
+        if self.in_flight:
+            oldest = next(iter(self.in_flight.values()))[0]
+            wake = min(wake, oldest + self.rto - now)
+        if len(self.in_flight) < int(self.cwnd) and (self.lost or self.next_new < self.chunk_count):
+            wake = min(wake, self.next_send - now)
+        return out, max(wake, 0.001)
+
+    def pick(self):
+        while self.lost:
+            chunk_id = self.lost.popleft()
+            if not self.acked[chunk_id] and chunk_id not in self.in_flight: return chunk_id, True
+        while self.next_new < self.chunk_count and self.acked[self.next_new]: self.next_new += 1
+        if self.next_new < self.chunk_count:
+            self.next_new += 1
+            return self.next_new - 1, False
+        return None, False
+
+    def expire(self, now):
+        expired = []
+        for chunk_id, (sent, _) in self.in_flight.items():
+            if now - sent <= self.rto: break
+            expired.append(chunk_id)
+        if not expired: return
+        for chunk_id in expired:
+            del self.in_flight[chunk_id]
+            self.lost.append(chunk_id)
+        self.ssthresh = max(self.cwnd / 2, 2.0)
+        self.cwnd = 2.0
+        self.rto = min(self.rto * 2, MAX_RTO)
+        self.last_cut = now
+
+    def on_ack(self, cum, echo, bitmap, now):
+        self.offer_acked = True
+        sent = self.in_flight.get(echo)
+        if sent and not sent[1]: self.sample_rtt(now - sent[0])
+
+        # Chunks a resuming receiver already holds don't count as window growth
+        grow = echo != OFFER_CHUNK
+        for chunk_id in range(self.cum, min(cum, self.chunk_count)): self.mark_acked(chunk_id, grow)
+        self.cum = max(self.cum, cum)
+
+        highest = cum
+        for byte_index, bits in enumerate(bitmap):
+            while bits:
+                low = bits & -bits
+                highest = cum + 1 + byte_index * 8 + low.bit_length() - 1
+                if highest < self.chunk_count: self.mark_acked(highest, grow)
+                bits ^= low
+
+        # NACK: holes below the highest received chunk that were sent before the echoed chunk are lost
+        if sent and highest > cum:
+            lost_any = False
+            for chunk_id in range(cum, highest):
+                flight = self.in_flight.get(chunk_id)
+                if flight and flight[0] < sent[0]:
+                    del self.in_flight[chunk_id]
+                    self.lost.append(chunk_id)
+                    lost_any = True
+            if lost_any and now - self.last_cut > (self.srtt or self.rto):
+                self.ssthresh = self.cwnd = max(self.cwnd * LOSS_BACKOFF, 2.0)
+                self.last_cut = now
+
+    def mark_acked(self, chunk_id, grow=True):
+        if self.acked[chunk_id]: return
+        self.acked[chunk_id] = 1
+        self.acked_count += 1
+        self.in_flight.pop(chunk_id, None)
+        self.last_progress = time.time()
+        if not grow: return
+        if self.cwnd < self.ssthresh: self.cwnd += 1.0
+        else: self.cwnd += 1.0 / self.cwnd
+        self.cwnd = min(self.cwnd, float(MAX_WINDOW))
+
+    def sample_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+class FileReceiver:
+    """Tracks which chunks of an incoming file have arrived and builds the ACK/NACK bitmap.
+    Chunks are written straight to their offset in a preallocated part file, so memory stays flat.
+    The received bitmap is persisted next to the part file so a later offer of the same digest resumes.
+    With no part_path the blob is already cached and the receiver starts complete."""
+    def __init__(self, xfer_id, filename, file_size, chunk_count, digest, part_path=None, map_path=None):
+        self.xfer_id = xfer_id
+        self.filename = filename
+        self.file_size = file_size
+        self.chunk_count = chunk_count
+        self.digest = digest
+        self.part_path = part_path
+        self.map_path = map_path
+        self.received = bytearray(chunk_count)
+        self.received_count = 0
+        self.cum = 0
+        self.highest = -1
+        self.unsaved = 0
+        self.finished = False
+        self.last_activity = time.time()
+        self.f = None
+
+        if part_path is None:
+            self.received = bytearray(b"\1" * chunk_count)
+            self.received_count = self.cum = chunk_count
+            self.highest = chunk_count - 1
+            return
+
+        if os.path.exists(part_path) and os.path.getsize(part_path) == file_size:
+            self.f = open(part_path, 'r+b')
+            self.load_map()
+        else:
+            self.f = open(part_path, 'w+b')
+            try: self.f.truncate(file_size)
+            except OSError:
+                self.discard() # No half-made part file left behind
+                raise
+
+    def load_map(self):
+        try:
+            with open(self.map_path, 'rb') as f: saved = f.read()
+        except OSError: return
+        if len(saved) != self.chunk_count: return
+        self.received = bytearray(saved)
+        self.received_count = self.received.count(1)
+        self.highest = self.received.rfind(1)
+        while self.cum < self.chunk_count and self.received[self.cum]: self.cum += 1
+
+    def save_map(self):
+        if not self.f or not self.map_path: return
+        try:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            with open(self.map_path + ".tmp", 'wb') as f: f.write(self.received)
+            os.replace(self.map_path + ".tmp", self.map_path)
+            self.unsaved = 0
+        except OSError: pass
+
+    @property
+    def complete(self):
+        return self.received_count == self.chunk_count
+
+    def add(self, chunk_id, data):
+        self.last_activity = time.time()
+        if chunk_id >= self.chunk_count or self.received[chunk_id]: return False
+        self.f.seek(chunk_id * FILE_CHUNK_SIZE)
+        self.f.write(data)
+        self.received[chunk_id] = 1
+        self.received_count += 1
+        self.highest = max(self.highest, chunk_id)
+        while self.cum < self.chunk_count and self.received[self.cum]: self.cum += 1
+        self.unsaved += 1
+        if self.unsaved >= MAP_SAVE_EVERY: self.save_map()
+        return True
+
+    def bitmap(self, full=False):
+        """Bit i set means chunk cum + 1 + i has arrived; empty when nothing is missing below highest.
+        The full map (sent in reply to an offer) lets a resuming sender skip everything already held."""
+        span = self.highest - self.cum if full else min(self.highest - self.cum, BITMAP_CHUNKS)
+        if span <= 0: return b""
+        out = bytearray((span + 7) // 8)
+        base = self.cum + 1
+        for i in range(span):
+            if self.received[base + i]: out[i >> 3] |= 1 << (i & 7)
+        return bytes(out)
+
+    def close(self):
+        try:
+            if self.f: self.f.close()
+        except: pass
+
+    def suspend(self):
+        self.save_map()
+        self.close()
+
+    def discard(self):
+        self.close()
+        for path in (self.part_path, self.map_path):
+            try:
+                if path: os.remove(path)
+            except OSError: pass
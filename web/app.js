@@ -18,6 +18,7 @@ class App {
     this._injectDynamicHTML();
     this._initElements();
     this._bindEvents();
+    this.connectVideoFeed();
 
     eel.py_get_config()((conf) => {
       this.config = conf;
@@ -287,6 +288,9 @@ class App {
     this.ctxViewProfile     = document.getElementById('ctx-view-profile');
     this.ctxMakeSecondary   = document.getElementById('ctx-make-secondary');
     this.ctxBan             = document.getElementById('ctx-ban');
+    this.ctxVolume          = document.getElementById('ctx-volume');
+    this.ctxMuteUser        = document.getElementById('ctx-mute-user');
+    this.userAudio          = {}; // uid -> { volume, muted } for local playback only
 
     this.homeToast = document.getElementById('homeToast');
     this.roomToast = document.getElementById('roomToast');
@@ -399,6 +403,15 @@ class App {
         }
     });
 
+    // Older history is fetched a page at a time as the user scrolls up
+    this.historyIds = new Set();
+    this.chatMessages.addEventListener('scroll', () => {
+        if (this.chatMessages.scrollTop > 40 || !this.historyHasMore || this.historyLoading) return;
+        this.historyLoading = true;
+        eel.py_load_older_history()();
+        setTimeout(() => { this.historyLoading = false; }, 3000); // A lost page mustn't stop scrolling for good
+    });
+
     if (this.videoCanvas) {
         this.videoCanvas.addEventListener('dblclick', () => {
             if (this.fullscreenStreamBtn) this.fullscreenStreamBtn.click();
@@ -548,7 +561,7 @@ class App {
           }
       }
 
-      this.chatMessages.innerHTML = '';
+      this._resetChat();
       this.userList.innerHTML = '';
       this.originalNicks = {};
 
@@ -584,7 +597,7 @@ class App {
       if (!ip) return;
       this.currentRoomIsHost = false;
       
-      this.chatMessages.innerHTML = '';
+      this._resetChat();
       this.userList.innerHTML = '';
       this.originalNicks = {};
       
@@ -668,7 +681,7 @@ class App {
     });
 
     this.reenterBtn.addEventListener('click', () => {
-        this.chatMessages.innerHTML = '';
+        this._resetChat();
         this.userList.innerHTML = '';
         
         eel.py_reenter_vc()((roomInfo) => {
@@ -752,6 +765,7 @@ class App {
                     this.showToast('room', 'SCREEN SHARE ACTIVE');
                     this.streamModal.classList.add('hidden');
                     
+                    this.resetVideo();
                     eel.py_watch_stream(this.config.uid)();
                     this.watchingLabel.textContent = `WATCHING YOUR STREAM`;
                     this.videoSection.classList.remove('hidden');
@@ -807,6 +821,23 @@ class App {
         });
     }
     
+    if (this.ctxVolume) {
+        this.ctxVolume.addEventListener('input', () => {
+            const audio = this.userAudio[this._contextTarget] = this.userAudio[this._contextTarget] || { volume: 100, muted: false };
+            audio.volume = parseInt(this.ctxVolume.value);
+            eel.py_set_user_volume(this._contextTarget, audio.volume / 100)();
+        });
+    }
+
+    if (this.ctxMuteUser) {
+        this.ctxMuteUser.addEventListener('click', () => {
+            const audio = this.userAudio[this._contextTarget] = this.userAudio[this._contextTarget] || { volume: 100, muted: false };
+            audio.muted = !audio.muted;
+            eel.py_set_user_muted(this._contextTarget, audio.muted)();
+            this.contextMenu.classList.add('hidden');
+        });
+    }
+
     if (this.ctxMakeSecondary) {
         this.ctxMakeSecondary.addEventListener('click', () => {
             eel.py_request_secondary(this._contextTarget)();
@@ -950,7 +981,38 @@ class App {
     eel.py_send_chat(text)();
   }
 
-  onChatReceived(uid, nick, msg, dp, b64_img) {
+  _resetChat() {
+    this.chatMessages.innerHTML = '';
+    this.historyIds.clear();
+    this.historyHasMore = false;
+    this.historyLoading = false;
+  }
+
+  onHistoryPage(messages, hasMore, older, last = true) {
+    // A repeated request can bring rows that are already shown
+    messages = messages.filter(m => !this.historyIds.has(m.id));
+    messages.forEach(m => this.historyIds.add(m.id));
+    if (!older) {
+        if (hasMore) this.historyHasMore = true;
+        messages.forEach(m => this.onChatReceived(m.uid, m.nick, m.msg, m.dp, m.img, m.ts));
+        return;
+    }
+    // One request can be answered in several pages; only the last settles whether there is more
+    if (last) {
+        this.historyHasMore = hasMore;
+        this.historyLoading = false;
+    }
+    // Older pages go on top; keep the view where the user was reading
+    const box = this.chatMessages;
+    const fromBottom = box.scrollHeight - box.scrollTop;
+    for (let i = messages.length - 1; i >= 0; i--) {
+        const m = messages[i];
+        this.onChatReceived(m.uid, m.nick, m.msg, m.dp, m.img, m.ts, true);
+    }
+    box.scrollTop = box.scrollHeight - fromBottom;
+  }
+
+  onChatReceived(uid, nick, msg, dp, img_url, ts = null, prepend = false) {
     if (uid === "SYSTEM") {
         this.onSystemMessage(msg);
         return;
@@ -972,7 +1034,7 @@ class App {
     }
     
     const isMine = uid === this.config.uid;
-    const time = new Date().toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
+    const time = (ts ? new Date(ts * 1000) : new Date()).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
     const group = document.createElement('div');
     group.className = `msg-group${isMine ? ' own' : ''}`;
 
@@ -1000,15 +1062,15 @@ class App {
     let bodyEl = document.createElement('div');
     
     if (msg.startsWith('[IMAGE_PREVIEW]|')) {
-        const src = b64_img || msg.split('|')[1];
+        const src = img_url || msg.split('|')[1];
         bodyEl.className = 'msg-bubble';
-        bodyEl.innerHTML = `<strong>📷 Image Sent</strong><br><img src="${src}" class="msg-image" style="margin-top:6px; cursor:pointer;" />`;
+        bodyEl.innerHTML = `<strong>📷 Image Sent</strong><br><img src="${src}" class="msg-image" loading="lazy" decoding="async" style="margin-top:6px; cursor:pointer;" />`;
         bodyEl.querySelector('img').addEventListener('click', () => eel.py_open_file(msg.split('|')[1])());
     } else if (msg.startsWith('[VIDEO_PREVIEW]|')) {
         const vidPath = msg.split('|')[1];
         bodyEl.className = 'msg-bubble';
-        if (b64_img) {
-            bodyEl.innerHTML = `<strong>🎬 Video Sent</strong><br><img src="${b64_img}" class="msg-image" style="margin-top:6px; cursor:pointer;" title="Click to play video" />`;
+        if (img_url) {
+            bodyEl.innerHTML = `<strong>🎬 Video Sent</strong><br><img src="${img_url}" class="msg-image" loading="lazy" decoding="async" style="margin-top:6px; cursor:pointer;" title="Click to play video" />`;
         } else {
             bodyEl.innerHTML = `<strong>🎬 Video Sent</strong><br><span style="color:var(--text-muted); font-size:0.7rem; cursor:pointer;">(Click to play video)</span>`;
         }
@@ -1026,6 +1088,10 @@ class App {
     content.appendChild(bodyEl);
     group.appendChild(avatarEl);
     group.appendChild(content);
+    if (prepend) {
+        this.chatMessages.insertBefore(group, this.chatMessages.firstChild);
+        return;
+    }
     this.chatMessages.appendChild(group);
     
     requestAnimationFrame(() => {
@@ -1094,6 +1160,9 @@ class App {
         item.addEventListener('contextmenu', (e) => {
             e.preventDefault();
             this._contextTarget = u.uid;
+            const audio = this.userAudio[u.uid] || { volume: 100, muted: false };
+            if (this.ctxVolume) this.ctxVolume.value = audio.volume;
+            if (this.ctxMuteUser) this.ctxMuteUser.textContent = audio.muted ? 'Unmute User' : 'Mute User';
             this.contextMenu.classList.remove('hidden');
             const vw = window.innerWidth; const vh = window.innerHeight;
             this.contextMenu.style.left = (e.clientX + 160 > vw ? e.clientX - 160 : e.clientX) + 'px';
@@ -1105,6 +1174,7 @@ class App {
             if (liveBadge) {
                 liveBadge.addEventListener('click', (e) => {
                     e.stopPropagation();
+                    this.resetVideo();
                     eel.py_watch_stream(u.uid)();
                     this.watchingLabel.textContent = `WATCHING: ${u.nick.toUpperCase()}`;
                     this.videoSection.classList.remove('hidden');
@@ -1136,6 +1206,65 @@ class App {
       }
   }
 
+  setTransferProgress(direction, filename, percent) {
+      if (direction === 'up') {
+          this.uploadStatus.style.display = 'inline';
+          this.uploadStatus.style.color = 'var(--amber)';
+          this.uploadStatus.textContent = `⏳ Uploading... ${percent}%`;
+      } else if (percent < 100) {
+          this.uploadStatus.style.display = 'inline';
+          this.uploadStatus.style.color = 'var(--amber)';
+          this.uploadStatus.textContent = `⬇ ${filename} ${percent}%`;
+      } else {
+          this.uploadStatus.style.display = 'none';
+      }
+  }
+
+  connectVideoFeed() {
+      // Frames arrive as raw bytes on their own socket; eel's JSON channel is only the fallback
+      const ws = new WebSocket(`ws://${location.host}/video`);
+      ws.binaryType = 'arraybuffer';
+      ws.onmessage = (e) => this.renderVideoFrame(new Uint8Array(e.data));
+      ws.onclose = () => setTimeout(() => this.connectVideoFeed(), 2000);
+  }
+
+  resetVideo() {
+      // Deltas only make sense on top of the stream they came from; wait for its next keyframe
+      this.videoKeyed = false;
+      this.videoQueue = Promise.resolve();
+      if (this.videoCanvas) this.videoCanvas.getContext('2d').clearRect(0, 0, this.videoCanvas.width, this.videoCanvas.height);
+  }
+
+  renderVideoFrame(bytes) {
+      // Frames decode asynchronously but must be painted in order, so each waits on the previous one
+      this.videoQueue = (this.videoQueue || Promise.resolve()).then(() => this._composeVideoFrame(bytes)).catch(() => {});
+  }
+
+  async _composeVideoFrame(bytes) {
+      const canvas = this.videoCanvas;
+      if (!canvas || bytes.length < 5) return;
+      const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+      const key = view.getUint8(0) & 1, width = view.getUint16(1), height = view.getUint16(3);
+      if (key) {
+          if (canvas.width !== width || canvas.height !== height) { canvas.width = width; canvas.height = height; }
+          this.videoKeyed = true;
+      } else if (!this.videoKeyed || canvas.width !== width || canvas.height !== height) return;
+
+      const regions = [];
+      let off = 5;
+      while (off + 12 <= bytes.length) {
+          const x = view.getUint16(off), y = view.getUint16(off + 2), len = view.getUint32(off + 8);
+          const jpeg = new Blob([bytes.subarray(off + 12, off + 12 + len)], { type: 'image/jpeg' });
+          regions.push(createImageBitmap(jpeg).then(bmp => ({ x, y, bmp })));
+          off += 12 + len;
+      }
+      const ctx = canvas.getContext('2d');
+      for (const { x, y, bmp } of await Promise.all(regions)) {
+          ctx.drawImage(bmp, x, y);
+          bmp.close();
+      }
+  }
+
   _resetProfileInactivityTimer() {
       clearTimeout(this.profileInactivityTimer);
       this.profileInactivityTimer = setTimeout(() => {
@@ -1286,8 +1415,13 @@ class App {
 document.addEventListener('DOMContentLoaded', () => { window._app = new App(); });
 
 eel.expose(js_on_chat_received);
-function js_on_chat_received(uid, nick, msg, dp, b64_img) {
-    if(window._app) window._app.onChatReceived(uid, nick, msg, dp, b64_img);
+function js_on_chat_received(uid, nick, msg, dp, img_url) {
+    if(window._app) window._app.onChatReceived(uid, nick, msg, dp, img_url);
+}
+
+eel.expose(js_history_page);
+function js_history_page(messages, hasMore, older, last) {
+    if(window._app) window._app.onHistoryPage(messages, hasMore, older, last);
 }
 
 eel.expose(js_update_user_list);
@@ -1302,9 +1436,7 @@ function js_set_user_speaking(uid) {
 
 eel.expose(js_render_video);
 function js_render_video(b64) {
-    if(window._app && window._app.videoCanvas) {
-        window._app.videoCanvas.src = "data:image/jpeg;base64," + b64;
-    }
+    if(window._app) window._app.renderVideoFrame(Uint8Array.from(atob(b64), c => c.charCodeAt(0)));
 }
 
 eel.expose(js_upload_status);
@@ -1312,6 +1444,11 @@ function js_upload_status(isUploading, filename) {
     if(window._app) window._app.setUploadStatus(isUploading, filename);
 }
 
+eel.expose(js_transfer_progress);
+function js_transfer_progress(direction, filename, percent) {
+    if(window._app) window._app.setTransferProgress(direction, filename, percent);
+}
+
 eel.expose(js_on_room_accepted);
 function js_on_room_accepted(code, name) {
     if(window._app) {